@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-__all__ = ['core', 'commands', 'hash']
+__all__ = ['benchmark', 'cache', 'core', 'commands', 'executor', 'hash', 'metrics', 'plan', 'remote', 'transfer', 'watch']
 
 if __name__ == '__main__':
     import os, sys
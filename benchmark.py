@@ -0,0 +1,366 @@
+import argparse, binascii, fnmatch, math, os, random, re, resource, shutil, sys, tempfile, time, commands, core, executor, hash, metrics, transfer
+
+# Bytes of seeded random data that file contents are cut from.
+POOL_SIZE = 4 * 1024 * 1024
+
+def generate_tree(basepath, num_files=10000, depth=3, fanout=8, mean_size=16 * 1024, size_sigma=1.5, duplicate_ratio=0.1,
+                  seed=0):
+    '''Create `num_files` files below `basepath` in `depth` levels of `fanout` directories, with sizes around
+    `mean_size` and a `duplicate_ratio` of copies. The same `seed` yields the same tree. Returns the relpaths.'''
+    rng = random.Random(seed)
+    pool = '{:0{}x}'.format(rng.getrandbits(8 * POOL_SIZE), 2 * POOL_SIZE).decode('hex')
+    directories = ['']
+    for level in range(depth):
+        directories = [os.path.join(d, 'dir{:02d}'.format(i)) for d in directories for i in range(fanout)]
+    relpaths, contents = [], []
+    for i in xrange(num_files):
+        relpath = os.path.join(rng.choice(directories), 'file{:07d}.dat'.format(i))
+        if contents and rng.random() < duplicate_ratio:
+            data = rng.choice(contents)
+        else:
+            # Scale such that the mean of the distribution is mean_size.
+            size = min(int(rng.lognormvariate(0, size_sigma) * mean_size / math.exp(size_sigma ** 2 / 2)), POOL_SIZE)
+            offset = rng.randrange(POOL_SIZE - size + 1)
+            # Prefix the index, so that only intended duplicates share contents.
+            data = '{:d}\n'.format(i) + pool[offset:offset + size]
+            if len(contents) < 1000: contents.append(data)
+        path = os.path.join(basepath, relpath)
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f: f.write(data)
+        relpaths.append(relpath)
+    return relpaths
+
+def mutate_tree(basepath, relpaths, changed=0.05, moved=0.05, renamed=0.05, deleted=0.02, seed=1):
+    '''Change, move to another directory, rename within their directory, and delete the given fractions of the
+    `relpaths` below `basepath`. Returns the number of files affected by each.'''
+    rng = random.Random(seed)
+    relpaths = list(relpaths)
+    rng.shuffle(relpaths)
+    directories = sorted(set(os.path.dirname(relpath) for relpath in relpaths))
+    counts = dict()
+    start = 0
+    for kind, fraction in (('changed', changed), ('moved', moved), ('renamed', renamed), ('deleted', deleted)):
+        selection = relpaths[start:start + int(fraction * len(relpaths))]
+        start += len(selection)
+        counts[kind] = len(selection)
+        for relpath in selection:
+            path = os.path.join(basepath, relpath)
+            if kind == 'changed':
+                with open(path, 'ab') as f: f.write('changed\n')
+            elif kind == 'deleted':
+                os.remove(path)
+            else:
+                directory = rng.choice(directories) if kind == 'moved' else os.path.dirname(relpath)
+                name = ('moved-' if kind == 'moved' else 'renamed-') + os.path.basename(relpath)
+                os.rename(path, os.path.join(basepath, directory, name))
+    return counts
+
+def tree_size(basepath):
+    return sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(basepath) for name in names)
+
+def peak_rss():
+    '''Return the peak resident set size of the process in MB.'''
+    # Linux reports kilobytes, OS X bytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+
+def current_rss():
+    '''Return the resident set size of the process in bytes (Linux only).'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+class Quiet(object):
+    '''Discard what is printed within a `with` block.'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def measure(results, phase, func, num_files=0, num_bytes=0):
+    '''Run `func`, and add the phase's time, rates and the peak RSS so far to the `results`. Returns what `func` does.'''
+    starttime = time.time()
+    with Quiet():
+        value = func()
+    elapsedtime = max(time.time() - starttime, 1e-6)
+    results.append((phase, elapsedtime, num_files / elapsedtime, num_bytes / 1e6 / elapsedtime, peak_rss()))
+    return value
+
+def run(basepath, num_files=10000, jobs=1, algorithm=hash.DEFAULT_ALGORITHM, mutations={}, **tree_args):
+    '''Benchmark indexing, comparing and syncing a synthetic tree in the directory `basepath`, changed as
+    `mutate_tree` is told by `mutations`. Returns a list of (phase, seconds, files/s, MB/s, peak RSS in MB).'''
+    source, target = os.path.join(basepath, 'source'), os.path.join(basepath, 'target')
+    excludes = map(fnmatch.translate, commands.ARCHIVE_FILES)
+    index = lambda directory: core.create_index(directory, excludes=excludes, archive=commands.get_archive(directory),
+                                                jobs=jobs, algorithm=algorithm, full=False)
+    results = []
+    generate_tree(source, num_files=num_files, **tree_args)
+    num_bytes = tree_size(source)
+    measure(results, 'cold index', lambda: index(source), num_files, num_bytes)
+    measure(results, 'warm index', lambda: index(source), num_files)
+
+    shutil.copytree(source, target, ignore=shutil.ignore_patterns(*commands.ARCHIVE_FILES))
+    with Quiet():
+        target_index = index(target)
+    counts = mutate_tree(source, [fd.relpath for fd in target_index.files], **mutations)
+    source_index = measure(results, 'changed index', lambda: index(source), num_files)
+    changeset = measure(results, 'compare', lambda: source_index.compare(target_index), num_files)
+
+    # Move detection on its own: all files with the same contents, under similar names.
+    new_fds = [core.FileDescriptor(fd.relpath.replace('dir0', 'moved0'), fd.mtime, fd.size) for fd in target_index.files]
+    measure(results, 'move detection', lambda: core.fuzzy_match_names(new_fds, target_index.files), len(new_fds))
+    # Renamed under other parents as well, so that no basename matches and the bounded search does the pairing.
+    renamed_fds = [core.FileDescriptor(os.path.join('renamed', os.path.dirname(fd.relpath), 'g' + os.path.basename(fd.relpath)),
+                                       fd.mtime, fd.size) for fd in target_index.files]
+    measure(results, 'rename detection', lambda: core.fuzzy_match_names(renamed_fds, target_index.files), len(renamed_fds))
+
+    source_archive, target_archive = commands.get_archive(source), commands.get_archive(target)
+    sync_executor = executor.Executor(algorithm=algorithm)
+    num_changes = sum(counts.values())
+    changed_bytes = sum(fd.size for fd in changeset.new_files) + sum(new.size for new, old in changeset.file_changes)
+    measure(results, 'sync apply', lambda: commands.sync_command('apply source *', changeset, source, target, source_archive,
+                                                                 target_archive, sync_executor), num_changes, changed_bytes)
+    source_archive.close()
+    target_archive.close()
+    return results
+
+class RegexFilter(object):
+    '''The filter as it was before `core.FileFilter` combined its patterns, trying each regex in turn on the name of a
+    path. The baseline of `benchmark_filters`.'''
+    def __init__(self, includes=[], excludes=[]):
+        self.includes = [re.compile(pattern) for pattern in includes]
+        self.excludes = [re.compile(pattern) for pattern in excludes]
+
+    def is_filtered(self, path):
+        head, tail = os.path.split(path)
+        for include in self.includes:
+            if include.match(tail): return False
+        for exclude in self.excludes:
+            if exclude.match(tail): return True
+        return False
+
+def benchmark_filters(num_paths=200000, num_patterns=40, seed=0):
+    '''Time filtering `num_paths` synthetic paths with `num_patterns` globs in each kind of filter, which must agree.
+    Returns a list of (filter, seconds, paths/s).'''
+    rng = random.Random(seed)
+    globs = [rng.choice(['*.ext{:02d}', 'tmp{:02d}*', 'cache{:02d}', '*~{:02d}']).format(i) for i in range(num_patterns)]
+    basepath = tempfile.mkdtemp(prefix='pysync-filters-')
+    try:
+        with open(os.path.join(basepath, core.IGNORE_FILE), 'w') as f:
+            for glob in globs: f.write(glob + '\n')
+        paths = [os.path.join(basepath, 'dir{:03d}'.format(rng.randrange(1000)), rng.choice(['file', 'tmp', 'cache', 'x~']) +
+                              '{:02d}.ext{:02d}'.format(rng.randrange(2 * num_patterns), rng.randrange(2 * num_patterns)))
+                 for i in xrange(num_paths)]
+        excludes = map(fnmatch.translate, globs)
+        filters = [('regex per pattern', RegexFilter(excludes=excludes)),
+                   ('combined', core.FileFilter(excludes=excludes)),
+                   ('ignore file', core.FileFilter(basepath=basepath))]
+        results, decisions = [], []
+        for name, filefilter in filters:
+            starttime = time.time()
+            decisions.append([filefilter.is_filtered(path) for path in paths])
+            elapsedtime = max(time.time() - starttime, 1e-6)
+            results.append((name, elapsedtime, num_paths / elapsedtime))
+        if any(d != decisions[0] for d in decisions):
+            raise AssertionError('The filters disagree')
+    finally:
+        shutil.rmtree(basepath)
+    return results
+
+def generate_file(path, size, seed=0):
+    rng = random.Random(seed)
+    pool = '{:0{}x}'.format(rng.getrandbits(8 * POOL_SIZE), 2 * POOL_SIZE).decode('hex')
+    with open(path, 'wb') as f:
+        for offset in xrange(0, size, POOL_SIZE): f.write(pool[:min(POOL_SIZE, size - offset)])
+    # Read it once, so that the page cache holds it.
+    hash.digest(path, 'md5')
+
+def benchmark_hashes(basepath, size=256 * 1024 * 1024, seed=0):
+    '''Time hashing a file of `size` bytes in `basepath` with every available algorithm, read and memory-mapped.
+    Returns a list of (algorithm, reader, seconds, MB/s).'''
+    path = os.path.join(basepath, 'hashed.dat')
+    generate_file(path, size, seed)
+    results = []
+    for algorithm in sorted(hash.ALGORITHMS):
+        for reader, mmap_threshold in (('read', None), ('mmap', 0)):
+            starttime = time.time()
+            hash.digest(path, algorithm, mmap_threshold=mmap_threshold)
+            elapsedtime = max(time.time() - starttime, 1e-6)
+            results.append((algorithm, reader, elapsedtime, size / 1e6 / elapsedtime))
+    return results
+
+def benchmark_copy(basepath, size=256 * 1024 * 1024, seed=0):
+    '''Time copying a file of `size` bytes within `basepath` with each of the `transfer.MECHANISMS`, falling back to
+    a userspace copy where one is not available. Returns a list of (mechanism, mechanism used, seconds, MB/s).'''
+    source, target = os.path.join(basepath, 'source.dat'), os.path.join(basepath, 'target.dat')
+    generate_file(source, size, seed)
+    results = []
+    for mechanism in transfer.MECHANISMS:
+        if os.path.exists(target): os.remove(target)
+        starttime = time.time()
+        used = transfer.copyfile(source, target, mechanisms=[mechanism, 'userspace'])
+        elapsedtime = max(time.time() - starttime, 1e-6)
+        results.append((mechanism, used, elapsedtime, size / 1e6 / elapsedtime))
+    return results
+
+def baseline_walk(basepath):
+    '''Walk as pysync did before `core.walk`: `isdir` on every entry, then `isfile` and `stat` on files. Returns the
+    number of files and of system calls.'''
+    num_files = num_calls = 0
+    queue = [basepath]
+    while queue:
+        path = queue.pop()
+        num_calls += 1
+        if os.path.isdir(path):
+            queue += [os.path.join(path, child) for child in os.listdir(path)]
+            num_calls += 1
+        elif os.path.isfile(path):
+            os.stat(path)
+            num_files += 1
+            num_calls += 2
+    return num_files, num_calls
+
+def benchmark_walk(basepath, num_files=10000, **tree_args):
+    '''Time walking a synthetic tree in `basepath` the baseline way and with `core.walk`, with and without `scandir`,
+    counting a directory listing as one system call. Returns a list of (walker, seconds, files/s, calls per file).'''
+    generate_tree(basepath, num_files=num_files, **tree_args)
+    def core_walk(use_scandir):
+        scandir = core.scandir
+        if not use_scandir: core.scandir = None
+        metrics.reset()
+        try:
+            num_files = sum(1 for file in core.walk(basepath, core.FileFilter()))
+        finally:
+            core.scandir = scandir
+        return num_files, metrics.counters['stat_calls'] + metrics.counters['directories_listed']
+    walkers = [('baseline', lambda: baseline_walk(basepath)), ('listdir + stat', lambda: core_walk(False))]
+    if core.scandir: walkers.append(('scandir', lambda: core_walk(True)))
+    # Walk once up front, so that every walker finds the tree in the cache.
+    baseline_walk(basepath)
+    results = []
+    for name, walker in walkers:
+        starttime = time.time()
+        num_found, num_calls = walker()
+        elapsedtime = max(time.time() - starttime, 1e-6)
+        results.append((name, elapsedtime, num_found / elapsedtime, float(num_calls) / max(num_found, 1)))
+    metrics.reset()
+    return results
+
+class DictDescriptor:
+    '''A `core.FileDescriptor` as it was before it had slots: an instance dict and a hex digest.'''
+    def __init__(self, relpath, mtime, size, sha256=None):
+        self.relpath = relpath
+        self.mtime = mtime
+        self.size = size
+        self.sha256 = sha256
+
+def measure_index_memory(create, num_files, seed):
+    # Build the index in a child process, so that memory freed by one representation cannot be reused by the next.
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            rng = random.Random(seed)
+            before = current_rss()
+            index = core.FileIndex('/')
+            for i in xrange(num_files):
+                relpath = 'dir{:02d}/dir{:02d}/file{:07d}.dat'.format(rng.randrange(64), rng.randrange(64), i)
+                index.files.append(create(relpath, 1.5e9 + i, rng.randrange(1 << 20), os.urandom(32)))
+            # Comparing builds a path index of the target.
+            path_index = index.create_path_index()
+            os.write(write_end, str(current_rss() - before))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as f: return int(f.read() or 0)
+
+def benchmark_memory(num_files=1000000, seed=0):
+    '''Measure the memory that a `FileIndex` of `num_files` descriptors and its path index take, per file, with
+    `DictDescriptor`s and with `core.FileDescriptor`s. Returns a list of (representation, MB, bytes per file).'''
+    representations = [('dict, hex digest', lambda relpath, mtime, size, digest: DictDescriptor(relpath, mtime, size, binascii.hexlify(digest))),
+                       ('slots, binary digest', lambda relpath, mtime, size, digest: core.FileDescriptor(relpath, mtime, size, digest=digest))]
+    results = []
+    for name, create in representations:
+        num_bytes = measure_index_memory(create, num_files, seed)
+        results.append((name, num_bytes / 1e6, float(num_bytes) / num_files))
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='pysync-benchmark', description='Time pysync on a synthetic tree.')
+    parser.add_argument('--files', type=int, default=10000, help='number of files to generate')
+    parser.add_argument('--depth', type=int, default=3, help='directory levels')
+    parser.add_argument('--fanout', type=int, default=8, help='subdirectories per directory')
+    parser.add_argument('--mean-size', metavar='KB', type=float, default=16, help='mean file size')
+    parser.add_argument('--duplicates', metavar='ratio', type=float, default=0.1, help='fraction of files that duplicate another')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--changed', metavar='ratio', type=float, default=0.05, help='fraction of files to append to')
+    parser.add_argument('--moved', metavar='ratio', type=float, default=0.05, help='fraction of files to move to another directory')
+    parser.add_argument('--renamed', metavar='ratio', type=float, default=0.05, help='fraction of files to rename')
+    parser.add_argument('--deleted', metavar='ratio', type=float, default=0.02, help='fraction of files to delete')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    parser.add_argument('--hash', choices=sorted(hash.ALGORITHMS), default=hash.DEFAULT_ALGORITHM)
+    parser.add_argument('--dir', help='directory to create the trees in (default: a temporary one, removed afterwards)')
+    parser.add_argument('--filters', metavar='patterns', type=int, help='only time filtering --files paths with this many patterns')
+    parser.add_argument('--hashes', metavar='MB', type=float, help='only time hashing a file of this size with every algorithm')
+    parser.add_argument('--copy', metavar='MB', type=float, help='only time copying a file of this size with every mechanism')
+    parser.add_argument('--walk', action='store_true', help='only time walking the tree and count system calls per file')
+    parser.add_argument('--memory', action='store_true', help='only measure the memory an index of --files files takes per file')
+    args = parser.parse_args(argv[1:])
+
+    if args.filters is not None:
+        print '{:<20}{:>10}{:>14}'.format('filter', 'seconds', 'paths/s')
+        for name, elapsedtime, rate in benchmark_filters(num_paths=args.files, num_patterns=args.filters, seed=args.seed):
+            print '{:<20}{:>10.3f}{:>14.0f}'.format(name, elapsedtime, rate)
+        return
+    if args.memory:
+        print '{:<24}{:>10}{:>16}'.format('descriptors', 'MB', 'bytes/file')
+        for name, megabytes, per_file in benchmark_memory(num_files=args.files, seed=args.seed):
+            print '{:<24}{:>10.1f}{:>16.0f}'.format(name, megabytes, per_file)
+        return
+
+    basepath = args.dir or tempfile.mkdtemp(prefix='pysync-benchmark-')
+    if args.hashes is not None:
+        try:
+            results = benchmark_hashes(basepath, size=int(args.hashes * 1024 * 1024), seed=args.seed)
+        finally:
+            if not args.dir: shutil.rmtree(basepath)
+        print '{:<12}{:>8}{:>10}{:>10}'.format('algorithm', 'reader', 'seconds', 'MB/s')
+        for algorithm, reader, elapsedtime, rate in results:
+            print '{:<12}{:>8}{:>10.3f}{:>10.1f}'.format(algorithm, reader, elapsedtime, rate)
+        return
+    if args.copy is not None:
+        try:
+            results = benchmark_copy(basepath, size=int(args.copy * 1024 * 1024), seed=args.seed)
+        finally:
+            if not args.dir: shutil.rmtree(basepath)
+        print '{:<16}{:>16}{:>10}{:>10}'.format('mechanism', 'used', 'seconds', 'MB/s')
+        for mechanism, used, elapsedtime, rate in results:
+            print '{:<16}{:>16}{:>10.3f}{:>10.1f}'.format(mechanism, used, elapsedtime, rate)
+        return
+    if args.walk:
+        try:
+            results = benchmark_walk(basepath, num_files=args.files, depth=args.depth, fanout=args.fanout,
+                                     mean_size=int(args.mean_size * 1024), duplicate_ratio=args.duplicates, seed=args.seed)
+        finally:
+            if not args.dir: shutil.rmtree(basepath)
+        print '{:<16}{:>10}{:>12}{:>12}'.format('walker', 'seconds', 'files/s', 'calls/file')
+        for name, elapsedtime, rate, calls in results:
+            print '{:<16}{:>10.3f}{:>12.0f}{:>12.2f}'.format(name, elapsedtime, rate, calls)
+        return
+
+    try:
+        mutations = dict(changed=args.changed, moved=args.moved, renamed=args.renamed, deleted=args.deleted)
+        results = run(basepath, num_files=args.files, jobs=args.jobs, algorithm=args.hash, mutations=mutations, depth=args.depth,
+                      fanout=args.fanout, mean_size=int(args.mean_size * 1024), duplicate_ratio=args.duplicates, seed=args.seed)
+    finally:
+        if not args.dir: shutil.rmtree(basepath)
+    print '{:<16}{:>10}{:>12}{:>10}{:>14}'.format('phase', 'seconds', 'files/s', 'MB/s', 'peak RSS MB')
+    for phase, elapsedtime, files_rate, bytes_rate, rss in results:
+        print '{:<16}{:>10.3f}{:>12.0f}{:>10.1f}{:>14.1f}'.format(phase, elapsedtime, files_rate, bytes_rate, rss)
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from pysync import benchmark
+    benchmark.main(sys.argv)
@@ -0,0 +1,115 @@
+import metrics, os, sqlite3, time
+
+# Entries kept by default; at about 100 bytes each, the cache stays around 100 MB.
+DEFAULT_MAX_ENTRIES = 1000000
+
+def default_path():
+    '''Return the path of the machine-wide cache in the user's cache directory.'''
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pysync', 'hashes.db')
+
+def mtime_ns(st):
+    # Python 2 only has the float mtime, which converts to the same integer every time.
+    return getattr(st, 'st_mtime_ns', None) or int(round(st.st_mtime * 1e9))
+
+class HashCache:
+    '''Machine-wide SQLite store of digests by device and inode, valid while a file keeps its size and mtime. Beyond
+    `max_entries`, the least recently used entries are evicted on `close`.'''
+    UPSERT = """
+        insert into hashes (device, inode, algorithm, size, mtime_ns, digest, used)
+        values (?, ?, ?, ?, ?, ?, ?)
+        on conflict (device, inode, algorithm) do update
+        set size = excluded.size, mtime_ns = excluded.mtime_ns, digest = excluded.digest, used = excluded.used;
+    """
+    TOUCH = """
+        update hashes
+        set used = ?
+        where device = ? and inode = ? and algorithm = ?;
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, batch_size=1000):
+        self.path = path or default_path()
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.conn = None
+        # Buffered writes as (statement, parameters) in the order they were issued.
+        self.writes = []
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory): os.makedirs(directory)
+        # Other processes may be indexing as well; wait for their transactions rather than failing.
+        self.conn = sqlite3.connect(self.path, timeout=60.0)
+        self.conn.isolation_level = None
+        self.conn.execute('pragma journal_mode = wal;')
+        self.conn.execute('pragma synchronous = normal;')
+        self.conn.executescript("""
+            create table if not exists hashes (
+                device integer not null,
+                inode integer not null,
+                algorithm text not null,
+                size integer not null,
+                mtime_ns integer not null,
+                digest blob not null,
+                used real not null,
+                unique (device, inode, algorithm)
+            );
+            create index if not exists hashes_used on hashes (used);
+        """)
+        return self.conn
+
+    def get(self, st, algorithm):
+        '''Return the digest of the file with the `os.stat` result `st`, or `None` if it is not cached.'''
+        if not self.conn: self.open()
+        row = self.conn.execute('select size, mtime_ns, digest from hashes where device = ? and inode = ? and algorithm = ?;',
+                                (st.st_dev, st.st_ino, algorithm)).fetchone()
+        if not row or row[0] != st.st_size or row[1] != mtime_ns(st):
+            metrics.count('hash_cache_misses')
+            return None
+        metrics.count('hash_cache_hits')
+        self.write(HashCache.TOUCH, (time.time(), st.st_dev, st.st_ino, algorithm))
+        return str(row[2])
+
+    def put(self, st, algorithm, digest):
+        self.write(HashCache.UPSERT, (st.st_dev, st.st_ino, algorithm, st.st_size, mtime_ns(st), sqlite3.Binary(digest), time.time()))
+
+    def put_path(self, path, size, mtime, algorithm, digest):
+        '''Cache the `digest` of the file at `path`, unless it no longer has the `size` and `mtime` it was hashed at.'''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if st.st_size == size and st.st_mtime == mtime: self.put(st, algorithm, digest)
+
+    def write(self, statement, parameters):
+        self.writes.append((statement, parameters))
+        if len(self.writes) >= self.batch_size: self.flush()
+
+    def flush(self):
+        if not self.writes: return
+        if not self.conn: self.open()
+        with metrics.timer('sqlite'):
+            self.conn.execute('begin;')
+            try:
+                for statement, parameters in self.writes: self.conn.execute(statement, parameters)
+            except:
+                self.conn.execute('rollback;')
+                raise
+            self.conn.execute('commit;')
+        self.writes = []
+
+    def evict(self):
+        '''Delete the least recently used entries beyond `max_entries`.'''
+        if not self.conn: self.open()
+        excess = self.conn.execute('select count(*) from hashes;').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.conn.execute('delete from hashes where rowid in (select rowid from hashes order by used limit ?);', (excess,))
+            metrics.count('hash_cache_evictions', excess)
+
+    def close(self):
+        if self.writes:
+            self.flush()
+            self.evict()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -1,5 +1,8 @@
-import time, sys, os, datetime, argparse, fnmatch, core, re
-from collections import defaultdict
+import time, sys, os, datetime, argparse, cache, cProfile, fnmatch, core, executor, hash, metrics, plan, re, remote, signal, watch
+from multiprocessing.pool import ThreadPool
+
+# The archive database and the files SQLite keeps next to it.
+ARCHIVE_FILES = ['.pysync', '.pysync-wal', '.pysync-shm', '.pysync-journal']
 
 def get_archive(basepath):
     '''Get or create a suitable `Archive` for the `basepath`.'''
@@ -7,339 +10,530 @@ def get_archive(basepath):
     # archive_path = core.find_archive(basepath)
     return core.Archive(os.path.join(basepath, '.pysync'))
 
+def get_target_archive(location):
+    '''Get the `Archive` of a local target directory, or a `remote.Client` standing in for that of a served one.'''
+    return remote.Client(location) if remote.parse_location(location) else get_archive(location)
+
+def create_executor(target_archive, **kwargs):
+    '''Create the executor for operations on the target of `target_archive`.'''
+    if isinstance(target_archive, remote.Client): return remote.RemoteExecutor(target_archive, **kwargs)
+    return executor.Executor(**kwargs)
+
+def get_hash_cache(args):
+    '''Open the machine-wide hash cache, if asked for. Like archives, each thread needs its own.'''
+    if not args.inode_cache and not args.inode_cache_file: return None
+    return cache.HashCache(args.inode_cache_file, max_entries=args.inode_cache_size)
+
+def block_threshold(args):
+    return int(args.block_threshold * 1024 * 1024) if args.block_threshold is not None else None
+
+def mmap_threshold(args):
+    return int(args.mmap_threshold * 1024 * 1024) if args.mmap_threshold is not None else None
+
 def index(args):
     starttime = time.time()
-    excludes = [fnmatch.translate('.pysync')]
+    excludes = map(fnmatch.translate, ARCHIVE_FILES)
     if args.excludes: excludes += map(fnmatch.translate, args.excludes)
     archive = get_archive(args.directory)
-    index1 = core.create_index(args.directory, excludes=excludes, archive=archive)
+    hash_cache = get_hash_cache(args)
+    index1 = core.create_index(args.directory, excludes=excludes, archive=archive, jobs=args.jobs, processes=args.processes, full=args.full, algorithm=args.hash, block_threshold=block_threshold(args), hash_cache=hash_cache, mmap_threshold=mmap_threshold(args))
+    archive.close()
+    if hash_cache: hash_cache.close()
     elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
     print 'Loaded index with {} files in {}.'.format(len(index1.files), elapsedtime)
 
 
+def watch_directory(args):
+    excludes = map(fnmatch.translate, ARCHIVE_FILES)
+    if args.excludes: excludes += map(fnmatch.translate, args.excludes)
+    archive = get_archive(args.directory)
+    watcher = watch.Watcher(args.directory, archive, excludes=excludes, jobs=args.jobs, processes=args.processes,
+                            algorithm=args.hash, debounce=args.debounce)
+    # Stop as cleanly on a kill as on Ctrl-C, so that the archive no longer claims to be watched.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        archive.close()
+
+def serve(args):
+    server = remote.Server(args.directory, get_archive, jobs=args.jobs, processes=args.processes, token=remote.get_token())
+    if args.socket: address = args.socket
+    else:
+        host, _, port = args.listen.rpartition(':')
+        address = (host, int(port))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve(address)
+    except KeyboardInterrupt:
+        pass
+
 def clean(args):
     starttime = time.time()
-    excludes = [fnmatch.translate('.pysync')]
+    excludes = map(fnmatch.translate, ARCHIVE_FILES)
     if args.excludes: excludes += map(fnmatch.translate, args.excludes)
     archive = get_archive(args.directory)
-    index = core.create_index(args.directory, excludes=excludes, archive=archive)
+    hash_cache = get_hash_cache(args)
+    index = core.create_index(args.directory, excludes=excludes, archive=archive, jobs=args.jobs, processes=args.processes, full=args.full, algorithm=args.hash, lazy=True, block_threshold=block_threshold(args), hash_cache=hash_cache, mmap_threshold=mmap_threshold(args))
     elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
     print 'Loaded index with {} files in {}.'.format(len(index.files), elapsedtime)
 
-    hash_dict = defaultdict(list)
-    for fd in index.files:
-        hash_dict[fd.sha256].append(fd)
-    for h, fds in hash_dict.items():
-        if len(fds) < 2: del hash_dict[h]
+    hash_dict = core.find_duplicates(index, archive=archive, jobs=args.jobs, processes=args.processes, hash_cache=hash_cache)
+    if hash_cache: hash_cache.close()
 
     print 'Detected {} duplicate groups.'.format(len(hash_dict))
+    if args.plan:
+        plan.write_clean_plan(args.plan, os.path.abspath(args.directory), index.algorithm, hash_dict)
+        print 'Wrote plan to {}.'.format(args.plan)
+        archive.close()
+        return
     print 'Enter command:'
-    keep_regex = re.compile('keep (?P<pattern>.*)(?:[\s\n\r]*)')
-    delete_regex = re.compile('delete (?P<pattern>.*)(?:[\s\n\r]*)')
-    ignore_regex = re.compile('ignore (?P<pattern>.*)(?:[\s\n\r]*)')
     while True:
+        archive.flush()
         try:
             line = raw_input('> ')
         except EOFError:
             line = ''
         if not line or line == 'exit':
             break
-
-        if line == 'show':
-            for h, fds in hash_dict.iteritems():
-                print '{} files with SHA256 {}:'.format(len(fds), h)
-                for fd in fds:
-                    print '* {}'.format(fd.relpath)
-            continue
-
-        match = keep_regex.match(line)
-        if match:
-            pattern = match.group('pattern')
-            for h, fds in hash_dict.items():
-                delete_fds = [fd for fd in fds if not fnmatch.fnmatch(fd.relpath, pattern)]
-                if len(delete_fds) < len(fds):
-                    for delete_fd in delete_fds:
-                        del_path = os.path.join(args.directory, delete_fd.relpath)
-                        print 'Deleting {}...'.format(del_path)
-                        if not args.dryrun:
-                            try: os.remove(del_path)
-                            except OSError:
-                                sys.stderr.write('Could not remove {}.\n'.format(del_path))
-                                sys.stderr.flush()
-                        fds.remove(delete_fd)
-                    if len(fds) < 2: del hash_dict[h]
-            continue
-
-        match = ignore_regex.match(line)
-        if match:
-            pattern = match.group('pattern')
-            for h, fds in hash_dict.items():
-                for fd in fds[:]:
-                    if fnmatch.fnmatch(fd.relpath, pattern):
-                        print 'Ignoring {}...'.format(fd.relpath)
-                        fds.remove(fd)
+        if not clean_command(line, hash_dict, args.directory, archive, index.algorithm, dryrun=args.dryrun, link_mode=args.link_mode):
+            print 'Unknown command.'
+    archive.close()
+
+KEEP_REGEX = re.compile('keep (?P<pattern>.*)(?:[\s\n\r]*)')
+DELETE_REGEX = re.compile('delete (?P<pattern>.*)(?:[\s\n\r]*)')
+IGNORE_REGEX = re.compile('ignore (?P<pattern>.*)(?:[\s\n\r]*)')
+LINK_REGEX = re.compile('link (?P<pattern>.*)(?:[\s\n\r]*)')
+
+def clean_command(line, hash_dict, directory, archive, algorithm, dryrun=False, link_mode='hardlink', journal=None):
+    '''Carry out a clean command on the duplicate groups in `hash_dict`, skipping and recording operations in the
+    `journal`. Returns whether the command was known.'''
+    skip = lambda key: journal is not None and key in journal
+
+    if line == 'show':
+        for fds in hash_dict.itervalues():
+            print '{} files with {} {}:'.format(len(fds), algorithm, fds[0].hexdigest)
+            for fd in fds:
+                print '* {}'.format(fd.relpath)
+        return True
+
+    match = KEEP_REGEX.match(line) or DELETE_REGEX.match(line)
+    if match:
+        regex, _ = core.compile_glob(match.group('pattern'))
+        keep = match.re is KEEP_REGEX
+        for h, fds in hash_dict.items():
+            delete_fds = [fd for fd in fds if bool(regex.match(fd.relpath)) != keep]
+            if len(delete_fds) < len(fds):
+                for delete_fd in delete_fds:
+                    del_path = os.path.join(directory, delete_fd.relpath)
+                    print 'Deleting {}...'.format(del_path)
+                    key = repr(('delete', del_path))
+                    if not dryrun and not skip(key):
+                        try:
+                            os.remove(del_path)
+                            if journal is not None: journal.record(key)
+                        except OSError:
+                            sys.stderr.write('Could not remove {}.\n'.format(del_path))
+                            sys.stderr.flush()
+                # Rebuild the group in one pass; groups of many identical files are common.
+                fds[:] = [fd for fd in fds if bool(regex.match(fd.relpath)) == keep]
                 if len(fds) < 2: del hash_dict[h]
-            continue
-
-        match = delete_regex.match(line)
-        if match:
-            pattern = match.group('pattern')
-            for h, fds in hash_dict.items():
-                delete_fds = [fd for fd in fds if fnmatch.fnmatch(fd.relpath, pattern)]
-                if len(delete_fds) < len(fds):
-                    for delete_fd in delete_fds:
-                        del_path = os.path.join(args.directory, delete_fd.relpath)
-                        print 'Deleting {}...'.format(del_path)
-                        if not args.dryrun:
-                            try: os.remove(del_path)
-                            except OSError:
-                                sys.stderr.write('Could not remove {}.\n'.format(del_path))
-                                sys.stderr.flush()
-                        fds.remove(delete_fd)
-                    if len(fds) < 2: del hash_dict[h]
-            continue
-
-        print 'Unknown command.'
+        return True
+
+    match = IGNORE_REGEX.match(line)
+    if match:
+        regex, _ = core.compile_glob(match.group('pattern'))
+        for h, fds in hash_dict.items():
+            remaining = []
+            for fd in fds:
+                if regex.match(fd.relpath): print 'Ignoring {}...'.format(fd.relpath)
+                else: remaining.append(fd)
+            fds[:] = remaining
+            if len(fds) < 2: del hash_dict[h]
+        return True
+
+    match = LINK_REGEX.match(line)
+    if match:
+        # Keep the first file matching the pattern and replace its duplicates with links to it.
+        regex, _ = core.compile_glob(match.group('pattern'))
+        for h, fds in hash_dict.items():
+            keep_fds = [fd for fd in fds if regex.match(fd.relpath)]
+            if not keep_fds: continue
+            keep_path = os.path.join(directory, keep_fds[0].relpath)
+            for link_fd in fds:
+                if link_fd is keep_fds[0]: continue
+                link_path = os.path.join(directory, link_fd.relpath)
+                print 'Linking {} to {}...'.format(link_path, keep_path)
+                key = repr(('link', keep_path, link_path))
+                if not dryrun and not skip(key):
+                    try:
+                        core.link(keep_path, link_path, overwrite=True, mode=link_mode)
+                        st = os.stat(link_path)
+                        archive.insert(core.FileDescriptor(link_fd.relpath, st.st_mtime, st.st_size, digest=link_fd.digest))
+                        if journal is not None: journal.record(key)
+                    except EnvironmentError as e:
+                        sys.stderr.write('Could not link {}: {}\n'.format(link_path, e))
+                        sys.stderr.flush()
+            del hash_dict[h]
+        return True
+    return False
 
 
 def sync(args):
+    if args.lazy and args.streaming:
+        raise ValueError('Lazy hashing needs the in-memory comparison, not --streaming')
+    # A served target is indexed by its server, which keeps the archive.
+    client = remote.Client(args.target) if remote.parse_location(args.target) else None
+    if client and args.streaming:
+        raise ValueError('Served targets are compared in memory, not with --streaming')
     starttime = time.time()
-    excludes = [fnmatch.translate('.pysync')]
+    excludes = map(fnmatch.translate, ARCHIVE_FILES)
     if args.excludes: excludes += map(fnmatch.translate, args.excludes)
+    def index_side(directory, label):
+        if client and label == 'target':
+            fileindex = client.index(excludes=excludes, full=args.full, algorithm=args.hash, label=label)
+            elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
+            sys.stdout.write('[{}] Received index with {} files in {}.\n'.format(label, len(fileindex.files), elapsedtime))
+            sys.stdout.flush()
+            return fileindex
+        # SQLite connections are bound to their thread, so each side gets its own archive and hash cache here.
+        archive = get_archive(directory)
+        hash_cache = get_hash_cache(args)
+        try:
+            fileindex = core.create_index(directory, excludes=excludes, archive=archive, jobs=args.jobs, processes=args.processes,
+                                          full=args.full, lazy=args.lazy, algorithm=args.hash, collect=not args.streaming,
+                                          block_threshold=block_threshold(args), label=label, hash_cache=hash_cache,
+                                          mmap_threshold=mmap_threshold(args))
+        finally:
+            archive.close()
+            if hash_cache: hash_cache.close()
+        elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
+        if args.streaming: message = 'Updated archive of {} in {}.'.format(directory, elapsedtime)
+        else: message = 'Loaded index with {} files in {}.'.format(len(fileindex.files), elapsedtime)
+        # Write whole lines, so that the output of both sides does not mix within a line.
+        sys.stdout.write('[{}] {}\n'.format(label, message))
+        sys.stdout.flush()
+        return fileindex
+    # Both sides are independent and often on different disks, so index them concurrently.
+    pool = ThreadPool(2)
+    try:
+        results = [pool.apply_async(index_side, (directory, label)) for directory, label in ((args.source, 'source'), (args.target, 'target'))]
+        source_index, target_index = [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
     source_archive = get_archive(args.source)
-    source_index = core.create_index(args.source, excludes=excludes, archive=source_archive)
-    elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
-    print 'Loaded index with {} files in {}.'.format(len(source_index.files), elapsedtime)
-
-    target_archive = get_archive(args.target)
-    target_index = core.create_index(args.target, excludes=excludes, archive=target_archive)
-    elapsedtime = datetime.timedelta(seconds=time.time() - starttime)
-    print 'Loaded index with {} files in {}.'.format(len(target_index.files), elapsedtime)
-
-    changeset = source_index.compare(target_index)
-
+    target_archive = client or get_archive(args.target)
+    if args.streaming:
+        # Only the archives were kept up to date; merge their sorted contents.
+        if source_archive.get_algorithm() != target_archive.get_algorithm():
+            raise ValueError('The archives of {} and {} use different hash algorithms'.format(args.source, args.target))
+        encoding = 'utf-8' if isinstance(args.source, str) else None
+        with metrics.timer('compare'):
+            changeset = core.compare_sorted(source_archive.iterate(encoding), target_archive.iterate(encoding))
+    else:
+        with metrics.timer('compare'):
+            changeset = source_index.compare(target_index, source_archive, target_archive, args.jobs, args.processes)
+
+    if args.plan:
+        target = args.target if remote.parse_location(args.target) else os.path.abspath(args.target)
+        plan.write_sync_plan(args.plan, os.path.abspath(args.source), target, args.hash, changeset)
+        print 'Wrote plan to {}.'.format(args.plan)
+        source_archive.close()
+        target_archive.close()
+        return
+
+    hash_cache = get_hash_cache(args)
+    sync_executor = create_executor(target_archive, small_jobs=args.copy_jobs, large_jobs=args.large_copy_jobs, dryrun=args.dryrun,
+                                    verify=args.verify, retries=args.retries, algorithm=args.hash, local=args.local_source,
+                                    hash_cache=hash_cache)
     print 'Enter command:'
-    apply_regex = re.compile('apply (?P<location>source|target) (?P<pattern>.*)(?:[\s\n\r]*)')
-    revert_regex = re.compile('revert (?P<location>source|target) (?P<pattern>.*)(?:[\s\n\r]*)')
-    ignore_regex = re.compile('ignore (?P<location>source|target) (?P<pattern>.*)(?:[\s\n\r]*)')
     while True:
+        source_archive.flush()
+        target_archive.flush()
         try:
             line = raw_input('> ')
         except EOFError:
             line = ''
         if not line or line == 'exit':
             break
-
-        # Command: show
-        if line == 'show':
-            print '{} new files:'.format(len(changeset.new_files))
-            for desc in changeset.new_files:
-                print '\t{}'.format(desc.relpath)
-            print '{} deleted files:'.format(len(changeset.removed_files))
-            for desc in changeset.removed_files:
-                print '\t{}'.format(desc.relpath)
-            print '{} changed files:'.format(len(changeset.file_changes))
-            for new, old in changeset.file_changes:
-                print '\t{}'.format(old.relpath)
-            print '{} moved files:'.format(len(changeset.file_moves))
-            for new, old in changeset.file_moves:
-                print '\t{} -> {}'.format(old.relpath, new.relpath)
-            continue
-
-        # Command: apply
-        match = apply_regex.match(line)
-        if match:
-            location = match.group('location')
-            pattern = match.group('pattern')
-
-            # Apply new files.
-            if location == 'source':
-                copy_fds = [fd for fd in changeset.new_files if fnmatch.fnmatch(fd.relpath, pattern)]
-                for fd in copy_fds:
-                    source_path = os.path.join(args.source, fd.relpath)
-                    target_path = os.path.join(args.target, fd.relpath)
-                    print 'Copying {} to {}...'.format(source_path, target_path)
-                    changeset.new_files.remove(fd)
-                    if not args.dryrun:
-                        try:
-                            core.copy(source_path, target_path, overwrite=False)
-                            stat = os.stat(target_path)
-                            new_fd = core.FileDescriptor(relpath=fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=fd.sha256)
-                            target_archive.insert(new_fd)
-                        except EnvironmentError as e:
-                            sys.stderr.write('Could not copy {} to {}: {}\n', source_path, target_path, e)
-                            sys.stderr.flush()
-
-            # Apply deleted files.
-            if location == 'target':
-                del_fds = [fd for fd in changeset.removed_files if fnmatch.fnmatch(fd.relpath, pattern)]
-                for fd in del_fds:
-                    path = os.path.join(args.target, fd.relpath)
-                    print 'Deleting {}...'.format(path)
-                    changeset.removed_files.remove(fd)
-                    if not args.dryrun:
-                        try:
-                            os.remove(path)
-                            target_archive.delete(fd)
-                        except EnvironmentError as e:
-                            sys.stderr.write('Could not delete: {}\n', path, e)
-                            sys.stderr.flush()
-
-            # Apply file changes.
-            if location == 'source':
-                match_index = 0
-            elif location == 'target':
-                match_index = 1
-            changes = [fds for fds in changeset.file_changes if fnmatch.fnmatch(fds[match_index].relpath, pattern)]
-            for source_fd, target_fd in changes:
-                source_path = os.path.join(args.source, source_fd.relpath)
-                target_path = os.path.join(args.target, target_fd.relpath)
-                print 'Copying {} to {}...'.format(source_path, target_path)
-                changeset.file_changes.remove((source_fd, target_fd))
-                if not args.dryrun:
-                    try:
-                        core.copy(source_path, target_path, overwrite=True)
-                        stat = os.stat(target_path)
-                        new_fd = core.FileDescriptor(relpath=target_fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=source_fd.sha256)
-                        target_archive.update(new_fd)
-                    except EnvironmentError as e:
-                        sys.stderr.write('Could not copy {} to {}: {}\n', source_path, target_path, e)
-                        sys.stderr.flush()
-
-            # Apply file moves.
-            if location == 'source':
-                match_index = 0
-            elif location == 'target':
-                match_index = 1
-            changes = [fds for fds in changeset.file_moves if fnmatch.fnmatch(fds[match_index].relpath, pattern)]
-            for source_fd, target_fd in changes:
-                from_path = os.path.join(args.target, target_fd.relpath)
-                to_path = os.path.join(args.target, source_fd.relpath)
-                print 'Moving {} to {}...'.format(from_path, to_path)
-                changeset.file_moves.remove((source_fd, target_fd))
-                if not args.dryrun:
-                    try:
-                        core.move(from_path, to_path, overwrite=False)
-                        stat = os.stat(to_path)
-                        new_fd = core.FileDescriptor(relpath=source_fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=target_fd.sha256)
-                        target_archive.delete(target_fd)
-                        target_archive.insert(new_fd)
-                    except EnvironmentError as e:
-                        sys.stderr.write('Could not move {} to {}: {}\n', from_path, to_path, e)
-                        sys.stderr.flush()
-            continue
-
-        # Command: revert
-        match = revert_regex.match(line)
-        if match:
-            location = match.group('location')
-            pattern = match.group('pattern')
-
-            # Revert deleted files.
-            if location == 'target':
-                copy_fds = [fd for fd in changeset.removed_files if fnmatch.fnmatch(fd.relpath, pattern)]
-                for fd in copy_fds:
-                    source_path = os.path.join(args.source, fd.relpath)
-                    target_path = os.path.join(args.target, fd.relpath)
-                    print 'Copying {} to {}...'.format(target_path, source_path)
-                    changeset.removed_files.remove(fd)
-                    if not args.dryrun:
-                        try:
-                            core.copy(target_path, source_path, overwrite=False)
-                            stat = os.stat(source_path)
-                            new_fd = core.FileDescriptor(relpath=fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=fd.sha256)
-                            source_archive.insert(new_fd)
-                        except EnvironmentError as e:
-                            sys.stderr.write('Could not copy {} to {}: {}\n', target_path, source_path, e)
-                            sys.stderr.flush()
-
-            # Revert new files.
-            if location == 'source':
-                del_fds = [fd for fd in changeset.new_files if fnmatch.fnmatch(fd.relpath, pattern)]
-                for fd in del_fds:
-                    path = os.path.join(args.source, fd.relpath)
-                    print 'Deleting {}...'.format(path)
-                    changeset.new_files.remove(fd)
-                    if not args.dryrun:
-                        try:
-                            os.remove(path)
-                            source_archive.delete(fd)
-                        except EnvironmentError as e:
-                            sys.stderr.write('Could not delete {}: {}\n', path, e)
-                            sys.stderr.flush()
-
-            # Apply file changes.
-            if location == 'source':
-                match_index = 0
-            elif location == 'target':
-                match_index = 1
-            changes = [fds for fds in changeset.file_changes if fnmatch.fnmatch(fds[match_index].relpath, pattern)]
-            for source_fd, target_fd in changes:
-                source_path = os.path.join(args.source, source_fd.relpath)
-                target_path = os.path.join(args.target, target_fd.relpath)
-                print 'Copying {} to {}...'.format(target_path, source_path)
-                changeset.file_changes.remove((source_fd, target_fd))
-                if not args.dryrun:
-                    try:
-                        core.copy(target_path, source_path, overwrite=True)
-                        stat = os.stat(source_path)
-                        new_fd = core.FileDescriptor(relpath=source_fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=target_fd.sha256)
-                        source_archive.update(new_fd)
-                    except EnvironmentError as e:
-                        sys.stderr.write('Could not copy {} to {}: {}\n', target_path, source_path, e)
-                        sys.stderr.flush()
-
-            # Apply file moves.
-            if location == 'source':
-                match_index = 0
-            elif location == 'target':
-                match_index = 1
-            changes = [fds for fds in changeset.file_moves if fnmatch.fnmatch(fds[match_index].relpath, pattern)]
-            for source_fd, target_fd in changes:
-                from_path = os.path.join(args.source, source_fd.relpath)
-                to_path = os.path.join(args.source, target_fd.relpath)
-                print 'Moving {} to {}...'.format(from_path, to_path)
-                changeset.file_moves.remove((source_fd, target_fd))
-                if not args.dryrun:
-                    try:
-                        core.move(from_path, to_path, overwrite=False)
-                        stat = os.stat(to_path)
-                        new_fd = core.FileDescriptor(relpath=target_fd.relpath, mtime=stat.st_mtime, size=stat.st_size, sha256=source_fd.sha256)
-                        source_archive.delete(source_fd)
-                        source_archive.insert(new_fd)
-                    except EnvironmentError as e:
-                        sys.stderr.write('Could not move {} to {}: {}\n', from_path, to_path, e)
-                        sys.stderr.flush()
-            continue
-
-        print 'Unknown command.'
+        if not sync_command(line, changeset, args.source, args.target, source_archive, target_archive, sync_executor,
+                            threshold=block_threshold(args)):
+            print 'Unknown command.'
+    source_archive.close()
+    target_archive.close()
+    if hash_cache: hash_cache.close()
+
+APPLY_REGEX = re.compile('apply (?P<location>source|target) (?P<pattern>.*)(?:[\s\n\r]*)')
+REVERT_REGEX = re.compile('revert (?P<location>source|target) (?P<pattern>.*)(?:[\s\n\r]*)')
+
+def sync_command(line, changeset, source, target, source_archive, target_archive, sync_executor, threshold=None):
+    '''Carry out a sync command on the `changeset` between the directories `source` and `target`. Returns whether the
+    command was known. Files of at least `threshold` bytes are delta-copied where their block digests are known.'''
+    def get_blocks(archive, fd):
+        if threshold is None or fd.size < threshold: return None
+        return archive.get_blocks(fd)
+
+    # Command: show
+    if line == 'show':
+        print '{} new files:'.format(len(changeset.new_files))
+        for desc in changeset.new_files:
+            print '\t{}'.format(desc.relpath)
+        print '{} deleted files:'.format(len(changeset.removed_files))
+        for desc in changeset.removed_files:
+            print '\t{}'.format(desc.relpath)
+        print '{} changed files:'.format(len(changeset.file_changes))
+        for new, old in changeset.file_changes:
+            print '\t{}'.format(old.relpath)
+        print '{} moved files:'.format(len(changeset.file_moves))
+        for new, old in changeset.file_moves:
+            print '\t{} -> {}'.format(old.relpath, new.relpath)
+        return True
+
+    # Command: apply
+    match = APPLY_REGEX.match(line)
+    if match:
+        location = match.group('location')
+        pattern = match.group('pattern')
+        operations = []
+
+        # Apply new files.
+        if location == 'source':
+            copy_fds = changeset.new_files.match(pattern)
+            for fd in copy_fds:
+                source_path = os.path.join(source, fd.relpath)
+                target_path = os.path.join(target, fd.relpath)
+                changeset.new_files.remove(fd)
+                operations.append(executor.Operation(executor.Operation.COPY, source_path, target_path, target_archive,
+                                                     relpath=fd.relpath, digest=fd.digest, size=fd.size, mtime=fd.mtime,
+                                                     blocks=get_blocks(source_archive, fd)))
+
+        # Apply deleted files.
+        if location == 'target':
+            del_fds = changeset.removed_files.match(pattern)
+            for fd in del_fds:
+                path = os.path.join(target, fd.relpath)
+                changeset.removed_files.remove(fd)
+                operations.append(executor.Operation(executor.Operation.DELETE, None, path, target_archive, old_fd=fd))
+
+        # Apply file changes.
+        if location == 'source':
+            match_index = 0
+        elif location == 'target':
+            match_index = 1
+        changes = changeset.file_changes.match(pattern, key=match_index)
+        for fds in changes:
+            source_fd, target_fd = fds
+            source_path = os.path.join(source, source_fd.relpath)
+            target_path = os.path.join(target, target_fd.relpath)
+            changeset.file_changes.remove(fds)
+            operations.append(executor.Operation(executor.Operation.COPY, source_path, target_path, target_archive,
+                                                 relpath=target_fd.relpath, digest=source_fd.digest, size=source_fd.size, mtime=source_fd.mtime, overwrite=True,
+                                                 blocks=get_blocks(source_archive, source_fd), old_blocks=get_blocks(target_archive, target_fd),
+                                                 target_fd=target_fd))
+
+        # Apply file moves.
+        changes = changeset.file_moves.match(pattern, key=match_index)
+        for fds in changes:
+            source_fd, target_fd = fds
+            from_path = os.path.join(target, target_fd.relpath)
+            to_path = os.path.join(target, source_fd.relpath)
+            changeset.file_moves.remove(fds)
+            operations.append(executor.Operation(executor.Operation.MOVE, from_path, to_path, target_archive,
+                                                 relpath=source_fd.relpath, digest=target_fd.digest, old_fd=target_fd))
+        sync_executor.run(operations)
+        return True
+
+    # Command: revert
+    match = REVERT_REGEX.match(line)
+    if match:
+        location = match.group('location')
+        pattern = match.group('pattern')
+        operations = []
+
+        # Revert deleted files.
+        if location == 'target':
+            copy_fds = changeset.removed_files.match(pattern)
+            for fd in copy_fds:
+                source_path = os.path.join(source, fd.relpath)
+                target_path = os.path.join(target, fd.relpath)
+                changeset.removed_files.remove(fd)
+                operations.append(executor.Operation(executor.Operation.COPY, target_path, source_path, source_archive,
+                                                     relpath=fd.relpath, digest=fd.digest, size=fd.size, mtime=fd.mtime,
+                                                     blocks=get_blocks(target_archive, fd)))
+
+        # Revert new files.
+        if location == 'source':
+            del_fds = changeset.new_files.match(pattern)
+            for fd in del_fds:
+                path = os.path.join(source, fd.relpath)
+                changeset.new_files.remove(fd)
+                operations.append(executor.Operation(executor.Operation.DELETE, None, path, source_archive, old_fd=fd))
+
+        # Apply file changes.
+        if location == 'source':
+            match_index = 0
+        elif location == 'target':
+            match_index = 1
+        changes = changeset.file_changes.match(pattern, key=match_index)
+        for fds in changes:
+            source_fd, target_fd = fds
+            source_path = os.path.join(source, source_fd.relpath)
+            target_path = os.path.join(target, target_fd.relpath)
+            changeset.file_changes.remove(fds)
+            operations.append(executor.Operation(executor.Operation.COPY, target_path, source_path, source_archive,
+                                                 relpath=source_fd.relpath, digest=target_fd.digest, size=target_fd.size, mtime=target_fd.mtime, overwrite=True,
+                                                 blocks=get_blocks(target_archive, target_fd), old_blocks=get_blocks(source_archive, source_fd),
+                                                 target_fd=source_fd))
+
+        # Apply file moves.
+        changes = changeset.file_moves.match(pattern, key=match_index)
+        for fds in changes:
+            source_fd, target_fd = fds
+            from_path = os.path.join(source, source_fd.relpath)
+            to_path = os.path.join(source, target_fd.relpath)
+            changeset.file_moves.remove(fds)
+            operations.append(executor.Operation(executor.Operation.MOVE, from_path, to_path, source_archive,
+                                                 relpath=target_fd.relpath, digest=source_fd.digest, old_fd=source_fd))
+        sync_executor.run(operations)
+        return True
+    return False
+
+def apply_plan(args):
+    '''Carry out the `commands` on a plan written by `sync --plan` or `clean --plan`. Operations that are done are
+    recorded in a journal next to the plan, so that running the same commands again resumes after the last of them.'''
+    header, contents = plan.read_plan(args.plan)
+    journal = plan.Journal(plan.journal_path(args.plan)) if not args.dryrun else None
+    hash_cache = None
+    if header['plan'] == 'sync':
+        source_archive = get_archive(header['source'])
+        target_archive = get_target_archive(header['target'])
+        hash_cache = get_hash_cache(args)
+        for archive in (source_archive, target_archive):
+            if archive.get_algorithm() != header['algorithm']:
+                raise ValueError('The archive {} does not use the {} digests of the plan'.format(archive.path, header['algorithm']))
+        sync_executor = create_executor(target_archive, small_jobs=args.copy_jobs, large_jobs=args.large_copy_jobs, dryrun=args.dryrun,
+                                        verify=args.verify, retries=args.retries, algorithm=header['algorithm'],
+                                        local=args.local_source, journal=journal, hash_cache=hash_cache)
+        archives = [source_archive, target_archive]
+        run = lambda line: sync_command(line, contents, header['source'], header['target'], source_archive, target_archive,
+                                        sync_executor, threshold=block_threshold(args))
+    else:
+        archive = get_archive(header['directory'])
+        archives = [archive]
+        run = lambda line: clean_command(line, contents, header['directory'], archive, header['algorithm'], dryrun=args.dryrun,
+                                         link_mode=args.link_mode, journal=journal)
+    try:
+        for line in args.commands:
+            print '> {}'.format(line)
+            if not run(line): raise ValueError('Unknown command: {}'.format(line))
+            for archive in archives: archive.flush()
+    finally:
+        for archive in archives: archive.close()
+        if journal: journal.close()
+        if hash_cache: hash_cache.close()
 
 def main(argv):
     parser = argparse.ArgumentParser(prog='pysync')
     # parser.add_argument('--', dest='breaker', action='store_true')
+    parser.add_argument('--profile', metavar='file', help='run under cProfile and dump the stats to this file')
+    parser.add_argument('--stats', action='store_true', help='print counters and timers when done')
+    parser.add_argument('--metrics', metavar='file', help='write counters and timers to this file, as JSON if it ends with .json, else for Prometheus')
+    parser.add_argument('--inode-cache', action='store_true', help='look up and keep digests by inode in a cache shared by all trees, {}'.format(cache.default_path()))
+    parser.add_argument('--inode-cache-file', metavar='file', help='use this file as the inode cache')
+    parser.add_argument('--inode-cache-size', metavar='N', type=int, default=cache.DEFAULT_MAX_ENTRIES, help='number of digests the inode cache keeps')
     subparsers = parser.add_subparsers()
 
     indexparser = subparsers.add_parser('index')
     indexparser.add_argument('directory')
     indexparser.set_defaults(func=index)
     indexparser.add_argument('--excludes', metavar='pattern', nargs='+')
+    indexparser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    indexparser.add_argument('--processes', action='store_true', help='hash on worker processes instead of threads')
+    indexparser.add_argument('--hash', choices=sorted(hash.ALGORITHMS), default=hash.DEFAULT_ALGORITHM, help='hash algorithm for file digests')
+    indexparser.add_argument('--full', action='store_true', help='list every directory, even if unchanged since the last run (finds files added to directories whose mtime was restored)')
+    indexparser.add_argument('--block-threshold', metavar='MB', type=float, help='also record the digests of the blocks of files of at least this size, for delta copies')
+    indexparser.add_argument('--mmap-threshold', metavar='MB', type=float, help='hash files of at least this size from a memory map (unsafe if they are truncated meanwhile)')
+
+    watchparser = subparsers.add_parser('watch')
+    watchparser.add_argument('directory')
+    watchparser.set_defaults(func=watch_directory)
+    watchparser.add_argument('--excludes', metavar='pattern', nargs='+')
+    watchparser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    watchparser.add_argument('--processes', action='store_true', help='hash on worker processes instead of threads')
+    watchparser.add_argument('--hash', choices=sorted(hash.ALGORITHMS), default=hash.DEFAULT_ALGORITHM, help='hash algorithm for file digests')
+    watchparser.add_argument('--debounce', metavar='seconds', type=float, default=2.0, help='time a file must be left alone before it is hashed')
 
     indexparser = subparsers.add_parser('clean')
     indexparser.add_argument('directory')
     indexparser.set_defaults(func=clean)
     indexparser.add_argument('--excludes', metavar='pattern', nargs='+')
+    indexparser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    indexparser.add_argument('--processes', action='store_true', help='hash on worker processes instead of threads')
+    indexparser.add_argument('--hash', choices=sorted(hash.ALGORITHMS), default=hash.DEFAULT_ALGORITHM, help='hash algorithm for file digests')
+    indexparser.add_argument('--full', action='store_true', help='list every directory, even if unchanged since the last run (finds files added to directories whose mtime was restored)')
+    indexparser.add_argument('--block-threshold', metavar='MB', type=float, help='also record the digests of the blocks of files of at least this size, for delta copies')
+    indexparser.add_argument('--mmap-threshold', metavar='MB', type=float, help='hash files of at least this size from a memory map (unsafe if they are truncated meanwhile)')
     indexparser.add_argument('--dry-run', dest='dryrun', action='store_const', const=True, default=False)
+    indexparser.add_argument('--link-mode', choices=['hardlink', 'reflink'], default='hardlink', help='how the link command replaces duplicates')
+    indexparser.add_argument('--plan', metavar='file', help='write the duplicates to a plan file for apply-plan instead of prompting for commands')
+
+    serveparser = subparsers.add_parser('serve')
+    serveparser.add_argument('directory')
+    serveparser.set_defaults(func=serve)
+    serveparser.add_argument('--listen', metavar='host:port', default='127.0.0.1:{}'.format(remote.DEFAULT_PORT), help='TCP address to listen on; clients must present the token in ${}'.format(remote.TOKEN_VARIABLE))
+    serveparser.add_argument('--socket', metavar='path', help='listen on this Unix socket instead, which only the owner may use')
+    serveparser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    serveparser.add_argument('--processes', action='store_true', help='hash on worker processes instead of threads')
 
     syncparser = subparsers.add_parser('sync')
     syncparser.set_defaults(func=sync)
     syncparser.add_argument('source')
-    syncparser.add_argument('target')
+    syncparser.add_argument('target', help='a directory, or one served by pysync serve as HOST[:PORT]:PATH or [SOCKET]:PATH')
     syncparser.add_argument('--excludes', metavar='pattern', nargs='+')
+    syncparser.add_argument('--jobs', metavar='N', type=int, default=1, help='number of files to hash in parallel')
+    syncparser.add_argument('--processes', action='store_true', help='hash on worker processes instead of threads')
+    syncparser.add_argument('--hash', choices=sorted(hash.ALGORITHMS), default=hash.DEFAULT_ALGORITHM, help='hash algorithm for file digests')
+    syncparser.add_argument('--full', action='store_true', help='list every directory, even if unchanged since the last run (finds files added to directories whose mtime was restored)')
+    syncparser.add_argument('--block-threshold', metavar='MB', type=float, help='also record the digests of the blocks of files of at least this size, for delta copies')
+    syncparser.add_argument('--mmap-threshold', metavar='MB', type=float, help='hash files of at least this size from a memory map (unsafe if they are truncated meanwhile)')
     syncparser.add_argument('--dry-run', dest='dryrun', action='store_const', const=True, default=False)
+    syncparser.add_argument('--copy-jobs', metavar='N', type=int, default=8, help='number of files to copy or delete in parallel')
+    syncparser.add_argument('--large-copy-jobs', metavar='N', type=int, default=2, help='number of large files to copy in parallel')
+    syncparser.add_argument('--verify', action='store_true', help='hash copied data on the fly and check it against the index')
+    syncparser.add_argument('--retries', metavar='N', type=int, default=2, help='number of times to retry a copy that fails verification')
+    syncparser.add_argument('--local-source', choices=['copy', 'hardlink'], help='copy or hardlink files from an identical file already on the target side')
+    syncparser.add_argument('--lazy', action='store_true', help='hash only the files whose digests the comparison needs')
+    syncparser.add_argument('--streaming', action='store_true', help='compare the archives in a sorted merge instead of in memory')
+    syncparser.add_argument('--plan', metavar='file', help='write the changes to a plan file for apply-plan instead of prompting for commands')
+
+    planparser = subparsers.add_parser('apply-plan')
+    planparser.set_defaults(func=apply_plan)
+    planparser.add_argument('plan')
+    planparser.add_argument('commands', metavar='command', nargs='+', help="commands as at the prompt, e.g., 'apply source *'")
+    planparser.add_argument('--block-threshold', metavar='MB', type=float, help='delta-copy files of at least this size whose block digests are known')
+    planparser.add_argument('--dry-run', dest='dryrun', action='store_const', const=True, default=False)
+    planparser.add_argument('--copy-jobs', metavar='N', type=int, default=8, help='number of files to copy or delete in parallel')
+    planparser.add_argument('--large-copy-jobs', metavar='N', type=int, default=2, help='number of large files to copy in parallel')
+    planparser.add_argument('--verify', action='store_true', help='hash copied data on the fly and check it against the plan')
+    planparser.add_argument('--retries', metavar='N', type=int, default=2, help='number of times to retry a copy that fails verification')
+    planparser.add_argument('--local-source', choices=['copy', 'hardlink'], help='copy or hardlink files from an identical file already on the target side')
+    planparser.add_argument('--link-mode', choices=['hardlink', 'reflink'], default='hardlink', help='how the link command replaces duplicates')
 
     try:
         args = parser.parse_args(argv[1:])
     except StandardError as e:
         parser.print_help()
         sys.exit(1)
-    args.func(args)
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(args.func, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        args.func(args)
+    if args.stats or args.metrics: print metrics.summary()
+    if args.metrics: metrics.write(args.metrics)
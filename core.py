@@ -1,19 +1,46 @@
-import hash, os, re, sqlite3, sys, time, datetime, difflib, shutil
-from collections import defaultdict
+import binascii, errno, fnmatch, hash, json, metrics, os, re, sqlite3, stat, sys, time, shutil, transfer
+from bisect import bisect_left
+from collections import defaultdict, deque
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 
-class FileDescriptor:
-    def __init__(self, relpath, mtime, size, sha256=None):
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class FileDescriptor(object):
+    '''Describes a file by its path relative to the indexed directory, its mtime, size and binary digest. `hexdigest`
+    (or `sha256`, from when SHA256 was the only algorithm) gives the digest in hex.'''
+    __slots__ = ('relpath', 'mtime', 'size', 'digest')
+
+    def __init__(self, relpath, mtime, size, sha256=None, digest=None):
         self.relpath = relpath
         self.mtime = mtime
         self.size = size
-        self.sha256 = sha256
+        self.digest = digest
+        if sha256 is not None: self.sha256 = sha256
+
+    @property
+    def hexdigest(self):
+        return binascii.hexlify(self.digest) if self.digest is not None else None
+
+    @hexdigest.setter
+    def hexdigest(self, hexdigest):
+        self.digest = binascii.unhexlify(hexdigest) if hexdigest is not None else None
+
+    sha256 = hexdigest
 
     def __repr__(self):
-        return 'FileDescriptor({}, mtime={}, size={}, sha256={})'.format(repr(self.relpath), repr(self.mtime), repr(self.size), repr(self.sha256))
+        return 'FileDescriptor({}, mtime={}, size={}, digest={})'.format(repr(self.relpath), repr(self.mtime), repr(self.size), repr(self.hexdigest))
 
 class FileIndex:
-    def __init__(self, basepath):
+    def __init__(self, basepath, algorithm=hash.DEFAULT_ALGORITHM):
         self.basepath = basepath
+        self.algorithm = algorithm
         self.files = []
 
     def init_hashes(archive):
@@ -24,54 +51,170 @@ class FileIndex:
     def create_path_index(self):
         return dict([(d.relpath, d) for d in self.files])
 
-    def compare(self, target):
+    def compare(self, target, archive=None, target_archive=None, jobs=1, processes=False):
+        '''Compare this index as the source to the `target` index. Files left unhashed by a lazy `create_index` are
+        hashed only where the outcome depends on them (see `hash_needed`), and stored in the `archive` of their side.'''
+        if self.algorithm != target.algorithm:
+            raise ValueError('Cannot compare {} digests to {} digests'.format(self.algorithm, target.algorithm))
         changeset = ChangeSet()
         target_index = target.create_path_index()
+        hash_needed(self, target, target_index, archive, target_archive, jobs, processes)
 
         # Match source to target files by name.
         new_files = defaultdict(list)
         for fd in self.files:
             if fd.relpath in target_index:
                 target_fd = target_index[fd.relpath]
-                if fd.size != target_fd.size or fd.sha256 != target_fd.sha256:
+                if differs(fd, target_fd):
                     changeset.file_changes.append((fd, target_fd))
                 del target_index[fd.relpath]
             else:
-                new_files[fd.sha256].append(fd)
+                new_files[fd.digest].append(fd)
 
         # Find unmatched target files.
         deleted_files = defaultdict(list)
         for del_fd in target_index.itervalues():
-            deleted_files[del_fd.sha256].append(del_fd)
-
-        # Match unmatched files by content.
-        for del_fds in deleted_files.values():
-            sha256 = del_fds[0].sha256
-            new_fds = new_files[sha256]
-            if not new_fds: continue
-            del new_files[sha256]
-            del deleted_files[sha256]
-            matches, remnant_new_fds, remnant_del_fds = fuzzy_match_names(new_fds, del_fds)
-            for match in matches: changeset.file_moves.append(match)
-            for fd in remnant_new_fds: changeset.new_files.append(fd)
-            for fd in remnant_del_fds: changeset.removed_files.append(fd)
-
-        # Find still unmatched source and target files.
-        for new_fds in new_files.itervalues():
-            changeset.new_files += new_fds
-        for del_fds in deleted_files.itervalues():
-            changeset.removed_files += del_fds
+            deleted_files[del_fd.digest].append(del_fd)
+
+        match_moves(changeset, new_files, deleted_files)
         return changeset
 
+def compare_sorted(source_fds, target_fds):
+    '''Compare two streams of `FileDescriptor`s sorted by relpath, e.g., from `Archive.iterate`, in a single merge
+    pass. Unlike `FileIndex.compare`, only files without a counterpart of the same relpath are kept in memory.'''
+    changeset = ChangeSet()
+    new_files = defaultdict(list)
+    deleted_files = defaultdict(list)
+    source_fds, target_fds = iter(source_fds), iter(target_fds)
+    fd, target_fd = next(source_fds, None), next(target_fds, None)
+    while fd or target_fd:
+        if target_fd is None or (fd is not None and fd.relpath < target_fd.relpath):
+            new_files[fd.digest].append(fd)
+            fd = next(source_fds, None)
+        elif fd is None or target_fd.relpath < fd.relpath:
+            deleted_files[target_fd.digest].append(target_fd)
+            target_fd = next(target_fds, None)
+        else:
+            if differs(fd, target_fd):
+                changeset.file_changes.append((fd, target_fd))
+            fd, target_fd = next(source_fds, None), next(target_fds, None)
+    match_moves(changeset, new_files, deleted_files)
+    return changeset
+
+def hash_needed(source, target, target_index, archive=None, target_archive=None, jobs=1, processes=False):
+    '''Hash the unhashed files of the `source` and `target` indexes that the comparison depends on: possible changes
+    and possible moves. `target_index` maps the relpaths of the `target` to its files.'''
+    if all(fd.digest is not None for fd in source.files) and all(fd.digest is not None for fd in target.files): return
+    source_relpaths = set(fd.relpath for fd in source.files)
+    new_sizes = set(fd.size for fd in source.files if fd.relpath not in target_index)
+    deleted_sizes = set(fd.size for fd in target.files if fd.relpath not in source_relpaths)
+    source_fds, target_fds = [], []
+    for fd in source.files:
+        target_fd = target_index.get(fd.relpath)
+        if target_fd is None:
+            if fd.size in deleted_sizes: source_fds.append(fd)
+        elif fd.size == target_fd.size and fd.mtime != target_fd.mtime:
+            source_fds.append(fd)
+            target_fds.append(target_fd)
+    target_fds += [fd for fd in target.files if fd.relpath not in source_relpaths and fd.size in new_sizes]
+    hash_files([fd for fd in source_fds if fd.digest is None], source.basepath, archive, jobs, processes, source.algorithm)
+    hash_files([fd for fd in target_fds if fd.digest is None], target.basepath, target_archive, jobs, processes, target.algorithm)
+
+def differs(fd, target_fd):
+    '''Tell whether the contents of two files at the same relpath differ. Without both digests, as for lazily
+    indexed files, files of equal size and mtime are taken to be the same.'''
+    if fd.size != target_fd.size: return True
+    if fd.digest is None or target_fd.digest is None: return fd.mtime != target_fd.mtime
+    return fd.digest != target_fd.digest
+
+def match_moves(changeset, new_files, deleted_files):
+    '''Add the unmatched `new_files` and `deleted_files` (each grouped by digest) to the `changeset`, pairing them
+    up as moves where their contents agree.'''
+    # Match unmatched files by content.
+    for del_fds in deleted_files.values():
+        digest = del_fds[0].digest
+        # Unhashed files cannot be matched.
+        if digest is None or not new_files.get(digest): continue
+        new_fds = new_files[digest]
+        del new_files[digest]
+        del deleted_files[digest]
+        matches, remnant_new_fds, remnant_del_fds = fuzzy_match_names(new_fds, del_fds)
+        for match in matches: changeset.file_moves.append(match)
+        for fd in remnant_new_fds: changeset.new_files.append(fd)
+        for fd in remnant_del_fds: changeset.removed_files.append(fd)
+
+    # Find still unmatched source and target files.
+    for new_fds in new_files.itervalues():
+        changeset.new_files += new_fds
+    for del_fds in deleted_files.itervalues():
+        changeset.removed_files += del_fds
+
 
 class Archive:
-    def __init__(self, path):
+    '''SQLite store of `FileDescriptor`s. Writes are buffered and committed in batches of `batch_size`, or
+    at least every `commit_interval` seconds, so that a crash loses at most one batch.'''
+    UPSERT = """
+        insert into file_descriptors (relpath, size, mtime, sha256)
+        values (?, ?, ?, ?)
+        on conflict (relpath) do update
+        set size = excluded.size, mtime = excluded.mtime, sha256 = excluded.sha256;
+    """
+    DELETE = """
+        delete
+        from file_descriptors
+        where relpath = ?;
+    """
+    UPSERT_DIRECTORY = """
+        insert into directories (relpath, mtime, inode)
+        values (?, ?, ?)
+        on conflict (relpath) do update
+        set mtime = excluded.mtime, inode = excluded.inode;
+    """
+    DELETE_DIRECTORY = """
+        delete
+        from directories
+        where relpath = ?;
+    """
+    UPSERT_BLOCKS = """
+        insert into blocks (relpath, size, mtime, block_size, digests)
+        values (?, ?, ?, ?, ?)
+        on conflict (relpath) do update
+        set size = excluded.size, mtime = excluded.mtime, block_size = excluded.block_size, digests = excluded.digests;
+    """
+    DELETE_BLOCKS = """
+        delete
+        from blocks
+        where relpath = ?;
+    """
+    RENAME_BLOCKS = """
+        update or replace blocks
+        set relpath = ?
+        where relpath = ?;
+    """
+    SET_META = """
+        insert into meta (key, value)
+        values (?, ?)
+        on conflict (key) do update
+        set value = excluded.value;
+    """
+
+    # Seconds after which a watcher that has not checked in is presumed gone.
+    WATCH_TIMEOUT = 30.0
+
+    def __init__(self, path, batch_size=10000, commit_interval=10.0):
         self.path = path
         self.conn = None
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        # Buffered writes as (statement, parameters) in the order they were issued.
+        self.writes = []
+        self.last_flush = time.time()
 
     def open(self):
         self.conn = sqlite3.connect(self.path)
         self.conn.isolation_level = None
+        self.conn.execute('pragma journal_mode = wal;')
+        self.conn.execute('pragma synchronous = normal;')
         self.conn.executescript("""
             create table if not exists file_descriptors (
                 relpath text not null unique,
@@ -79,57 +222,207 @@ class Archive:
                 mtime real not null,
                 sha256 blob
             );
+            create index if not exists file_descriptors_sha256 on file_descriptors (sha256);
+            create table if not exists directories (
+                relpath text not null unique,
+                mtime real not null,
+                inode integer not null
+            );
+            create table if not exists blocks (
+                relpath text not null unique,
+                size integer not null,
+                mtime real not null,
+                block_size integer not null,
+                digests blob not null
+            );
+            create table if not exists meta (
+                key text not null unique,
+                value text
+            );
         """)
-        self.conn.commit()
+        self.last_flush = time.time()
         return self.conn
 
     def load(self):
+        '''Read all `FileDescriptor`s in a single scan, keyed by their (unicode) relpath.'''
         if not self.conn: self.open()
+        if self.writes: self.flush()
         contents = dict()
         c = self.conn.cursor()
-        for path, size, mtime, sha256 in c.execute('select * from file_descriptors;'):
-            contents[path] = FileDescriptor(relpath, mtime, size, sha256)
+        with metrics.timer('sqlite'):
+            for relpath, size, mtime, sha256 in c.execute('select relpath, size, mtime, sha256 from file_descriptors;'):
+                contents[relpath] = FileDescriptor(relpath, mtime, size, digest=Archive._decode_digest(sha256))
         return contents
 
+    def load_directories(self):
+        '''Read the (mtime, inode) of all directories as of their last listing, keyed by their (unicode) relpath.'''
+        if not self.conn: self.open()
+        if self.writes: self.flush()
+        c = self.conn.cursor()
+        return dict((relpath, (mtime, inode)) for relpath, mtime, inode in c.execute('select relpath, mtime, inode from directories;'))
+
+    def load_blocks(self):
+        '''Read the (size, mtime) that the block digests of files were recorded for, keyed by their (unicode) relpath.'''
+        if not self.conn: self.open()
+        if self.writes: self.flush()
+        c = self.conn.cursor()
+        return dict((relpath, (size, mtime)) for relpath, size, mtime in c.execute('select relpath, size, mtime from blocks;'))
+
+    def insert_directory(self, relpath, mtime, inode):
+        self.write(Archive.UPSERT_DIRECTORY, (Archive._make_unicode(relpath), mtime, inode))
+
+    def delete_directory(self, relpath):
+        self.write(Archive.DELETE_DIRECTORY, (Archive._make_unicode(relpath),))
+
+    def get_algorithm(self):
+        '''Return the hash algorithm of the archived digests. Archives from before it was recorded use SHA256.'''
+        return self.get_meta('algorithm') or hash.DEFAULT_ALGORITHM
+
+    def set_algorithm(self, algorithm):
+        '''Switch the archive to another hash algorithm, discarding all digests made with the previous one.'''
+        recorded = self.get_meta('algorithm')
+        if recorded == algorithm: return
+        if (recorded or hash.DEFAULT_ALGORITHM) != algorithm:
+            self.write('update file_descriptors set sha256 = null;', ())
+            self.write('delete from blocks;', ())
+        self.set_meta('algorithm', algorithm)
+        self.flush()
+
+    def get_meta(self, key):
+        if not self.conn: self.open()
+        if self.writes: self.flush()
+        row = self.conn.execute('select value from meta where key = ?;', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.write(Archive.SET_META, (key, value))
+
+    def iterate(self, encoding=None):
+        '''Stream all `FileDescriptor`s ordered by relpath, which is encoded with `encoding` if given.'''
+        if not self.conn: self.open()
+        if self.writes: self.flush()
+        c = self.conn.cursor()
+        for relpath, size, mtime, sha256 in c.execute('select relpath, size, mtime, sha256 from file_descriptors order by relpath;'):
+            if encoding: relpath = relpath.encode(encoding)
+            yield FileDescriptor(relpath, mtime, size, digest=Archive._decode_digest(sha256))
+
     def get(self, path):
         if not self.conn: self.open()
+        if self.writes: self.flush()
         row = self.conn.execute('''
             select size, mtime, sha256 from file_descriptors where relpath = ?;
         ''', (Archive._make_unicode(path),)).fetchone()
-        return FileDescriptor(path, size=row[0], mtime=row[1], sha256=row[2]) if row else None
+        return FileDescriptor(path, size=row[0], mtime=row[1], digest=Archive._decode_digest(row[2])) if row else None
 
     def __getitem__(self, path):
         return self.get(path)
 
-    def update(self, fd):
+    def find(self, digest):
+        '''Return the `FileDescriptor` of some file with the given `digest`, or `None`.'''
         if not self.conn: self.open()
-        self.conn.execute("""
-            update file_descriptors
-            set size = ?, mtime = ?, sha256 = ?
-            where relpath = ?;
-        """, (fd.size, fd.mtime, fd.sha256, Archive._make_unicode(fd.relpath)))
+        if self.writes: self.flush()
+        row = self.conn.execute('''
+            select relpath, size, mtime from file_descriptors where sha256 = ? limit 1;
+        ''', (Archive._encode_digest(digest),)).fetchone()
+        return FileDescriptor(row[0], size=row[1], mtime=row[2], digest=digest) if row else None
+
+    def update(self, fd):
+        self.insert(fd)
 
     def delete(self, fd):
+        self.write(Archive.DELETE, (Archive._make_unicode(fd.relpath),))
+        self.write(Archive.DELETE_BLOCKS, (Archive._make_unicode(fd.relpath),))
+
+    def get_blocks(self, fd):
+        '''Return the (block_size, digests) of the fixed-size blocks of the file, if they were recorded for its current
+        size and mtime, or `None`.'''
         if not self.conn: self.open()
-        self.conn.execute("""
-            delete
-            from file_descriptors
-            where relpath = ?;
-        """, (Archive._make_unicode(fd.relpath),))
+        if self.writes: self.flush()
+        row = self.conn.execute('''
+            select size, mtime, block_size, digests from blocks where relpath = ?;
+        ''', (Archive._make_unicode(fd.relpath),)).fetchone()
+        if not row or row[0] != fd.size or row[1] != fd.mtime: return None
+        block_size, digests = row[2], str(row[3])
+        num_blocks = (fd.size + block_size - 1) // block_size
+        digest_size = len(digests) // num_blocks if num_blocks else 0
+        return block_size, [digests[i:i + digest_size] for i in xrange(0, len(digests), digest_size or 1)]
+
+    def insert_blocks(self, fd, block_size, digests):
+        self.write(Archive.UPSERT_BLOCKS, (Archive._make_unicode(fd.relpath), fd.size, fd.mtime, block_size, sqlite3.Binary(''.join(digests))))
+
+    def rename_blocks(self, relpath, new_relpath):
+        self.write(Archive.RENAME_BLOCKS, (Archive._make_unicode(new_relpath), Archive._make_unicode(relpath)))
+
+    def rename_tree(self, relpath, new_relpath):
+        '''Move the records of the file or directory `relpath` and of everything below it to `new_relpath`.'''
+        relpath, new_relpath = Archive._make_unicode(relpath), Archive._make_unicode(new_relpath)
+        for table in ('file_descriptors', 'blocks', 'directories'):
+            # Paths below relpath sort between relpath + '/' and relpath + '0', the character after '/'.
+            self.write('update or replace {} set relpath = ? || substr(relpath, ?) where relpath = ? or (relpath > ? and relpath < ?);'.format(table),
+                       (new_relpath, len(relpath) + 1, relpath, relpath + u'/', relpath + u'0'))
+
+    def delete_tree(self, relpath):
+        '''Delete the records of the file or directory `relpath` and of everything below it.'''
+        relpath = Archive._make_unicode(relpath)
+        for table in ('file_descriptors', 'blocks', 'directories'):
+            self.write('delete from {} where relpath = ? or (relpath > ? and relpath < ?);'.format(table),
+                       (relpath, relpath + u'/', relpath + u'0'))
+
+    def is_watched(self, filter_key=None):
+        '''Whether a running `watch.Watcher` keeps the archive current, with nothing left to hash, so that it can stand
+        in for a walk of the directory. With a `filter_key`, the watcher must also use the same filter.'''
+        pid = self.get_meta('watch_pid')
+        if not pid: return False
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            if e.errno != errno.EPERM: return False
+        heartbeat = float(self.get_meta('watch_heartbeat') or 0)
+        return (time.time() - heartbeat < Archive.WATCH_TIMEOUT and self.get_meta('watch_pending') == '0' and
+                (filter_key is None or self.get_meta('filter') == filter_key))
 
     def insert(self, fd):
+        self.write(Archive.UPSERT, (Archive._make_unicode(fd.relpath), fd.size, fd.mtime, Archive._encode_digest(fd.digest)))
+
+    def write(self, statement, parameters):
+        self.writes.append((statement, parameters))
+        if len(self.writes) >= self.batch_size or time.time() - self.last_flush >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        '''Commit all buffered writes in a single transaction.'''
         if not self.conn: self.open()
-        self.delete(fd)
-        self.conn.execute("""
-            insert into file_descriptors (relpath, size, mtime, sha256)
-            values (?, ?, ?, ?);
-        """, (Archive._make_unicode(fd.relpath), fd.size, fd.mtime, fd.sha256))
+        if self.writes:
+            with metrics.timer('sqlite'):
+                self.conn.execute('begin;')
+                try:
+                    for statement, group in groupby(self.writes, key=lambda write: write[0]):
+                        self.conn.executemany(statement, [parameters for _, parameters in group])
+                except:
+                    self.conn.execute('rollback;')
+                    raise
+                self.conn.execute('commit;')
+            metrics.count('sqlite_writes', len(self.writes))
+            self.writes = []
+        self.last_flush = time.time()
 
     def close(self):
+        if self.conn or self.writes: self.flush()
         if self.conn:
             self.conn.close()
             self.conn = None
 
+    @staticmethod
+    def _encode_digest(digest):
+        return sqlite3.Binary(digest) if digest is not None else None
+
+    @staticmethod
+    def _decode_digest(value):
+        # Older archives store hex digests as text.
+        if value is None: return None
+        elif isinstance(value, unicode): return binascii.unhexlify(value)
+        else: return str(value)
+
     @staticmethod
     def _make_unicode(path):
         if type(path) == str: return path.decode('utf-8')
@@ -137,61 +430,508 @@ class Archive:
         else: raise ValueError('Illegal path: {}'.format(repr(path)))
 
 class ChangeSet:
+    '''The differences between two indexes. New and removed files are `FileDescriptor`s; changed and moved files are
+    (source, target) pairs of them, which can be looked up by either relpath.'''
     def __init__(self):
-        self.removed_files = []
-        self.new_files = []
-        self.file_changes = []
-        self.file_moves = []
+        self.removed_files = PathIndex()
+        self.new_files = PathIndex()
+        pair_keys = (lambda fds: fds[0].relpath, lambda fds: fds[1].relpath)
+        self.file_changes = PathIndex(keys=pair_keys)
+        self.file_moves = PathIndex(keys=pair_keys)
+
+def compile_glob(pattern):
+    '''Compile the shell-style `pattern` as `fnmatch` does, and return it along with its literal prefix, which all
+    matching paths start with.'''
+    prefix = re.match(r'[^*?[]*', pattern).group(0)
+    return re.compile(fnmatch.translate(pattern)), prefix
+
+class PathIndex(object):
+    '''A list-like collection of entries that finds those whose relpath (by each of the `keys`) matches a glob without
+    testing every entry. Removing an entry takes constant time.'''
+    def __init__(self, entries=(), keys=(lambda fd: fd.relpath,)):
+        self.keys = keys
+        # Entries in the order they were added, with None in place of removed ones.
+        self.entries = []
+        self.slots = dict()
+        # Per key, the sorted (relpath, slot) of all entries added, or None if to be sorted anew.
+        self.sorted = [None] * len(keys)
+        self.extend(entries)
+
+    def append(self, entry):
+        self.slots[id(entry)] = len(self.entries)
+        self.entries.append(entry)
+        self.sorted = [None] * len(self.keys)
+
+    def extend(self, entries):
+        for entry in entries: self.append(entry)
+
+    def __iadd__(self, entries):
+        self.extend(entries)
+        return self
+
+    def remove(self, entry):
+        self.entries[self.slots.pop(id(entry))] = None
+        # Drop the leftovers once they make up most of the index.
+        if len(self.entries) > 2 * len(self.slots) + 1024: self.compact()
+
+    def compact(self):
+        entries = [entry for entry in self.entries if entry is not None]
+        self.entries, self.slots = [], dict()
+        self.extend(entries)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return (entry for entry in self.entries if entry is not None)
+
+    def match(self, pattern, key=0):
+        '''Return the entries whose relpath by the `key`-th key function matches the glob `pattern`, in the order they
+        were added.'''
+        if self.sorted[key] is None:
+            self.sorted[key] = sorted((self.keys[key](entry), slot) for slot, entry in enumerate(self.entries) if entry is not None)
+        regex, prefix = compile_glob(pattern)
+        index = self.sorted[key]
+        slots = []
+        for position in xrange(bisect_left(index, (prefix,)), len(index)):
+            relpath, slot = index[position]
+            if not relpath.startswith(prefix): break
+            if self.entries[slot] is not None and regex.match(relpath): slots.append(slot)
+        return [self.entries[slot] for slot in sorted(slots)]
+
+
+# Per-directory rule files, in the syntax of .gitignore.
+IGNORE_FILE = '.pysyncignore'
 
+def combine_patterns(patterns):
+    '''Compile the regexes into one that matches where any of them does, or return `None` if there are none.'''
+    return re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns)) if patterns else None
+
+def translate_ignore_pattern(pattern):
+    '''Translate a glob of an ignore file into a regex. `*` and `?` stay within a path component, while `**` spans any
+    number of them.'''
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        c = pattern[i]
+        i += 1
+        if c == '*' and pattern.startswith('*', i):
+            parts.append('.*')
+            i += 1
+        elif c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            # As in fnmatch, a leading ! negates the set and a ] right after the [ is literal.
+            j = i
+            if j < n and pattern[j] == '!': j += 1
+            if j < n and pattern[j] == ']': j += 1
+            while j < n and pattern[j] != ']': j += 1
+            if j >= n:
+                parts.append('\\[')
+            else:
+                chars = pattern[i:j].replace('\\', '\\\\')
+                if chars[0] == '!': chars = '^' + chars[1:]
+                elif chars[0] == '^': chars = '\\' + chars
+                parts.append('[{}]'.format(chars))
+                i = j + 1
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+def read_ignore_file(path, relpath):
+    '''Return the rules of the ignore file at `path` in the directory `relpath` as (anchored, regex, negated).
+    Anchored rules match relpaths, the others names.'''
+    rules = []
+    prefix = re.escape(relpath + '/') if relpath else ''
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.endswith(' ') and not line.endswith('\\ '): line = line.rstrip(' ')
+            if not line or line.startswith('#'): continue
+            negated = line.startswith('!')
+            if negated or line.startswith('\\'): line = line[1:]
+            anchored = '/' in line.rstrip('/')
+            # Rules with a trailing slash only match directories.
+            regex = translate_ignore_pattern(line.strip('/')) + ('/' if line.endswith('/') else '/?') + '\\Z'
+            rules.append((anchored, prefix + regex if anchored else regex, negated))
+    return rules
 
 class FileFilter:
-    def __init__(self, includes=[], excludes=[]):
-        self.includes = [re.compile(pattern) for pattern in includes]
-        self.excludes = [re.compile(pattern) for pattern in excludes]
-    def is_filtered(self, path):
-        head, tail = os.path.split(path)
-        for include in self.includes:
-            if include.match(tail): return False
-        for exclude in self.excludes:
-            if exclude.match(tail): return True
-        return False
+    '''Decides which paths to leave out of a walk: `includes` override `excludes` (regexes on names), and below
+    `basepath` the `ignore_file`s of the directories add rules as in .gitignore.'''
+    def __init__(self, includes=[], excludes=[], basepath=None, ignore_file=IGNORE_FILE):
+        self.include = combine_patterns(includes)
+        self.exclude = combine_patterns(excludes)
+        self.basepath = os.path.normpath(basepath) if basepath is not None else None
+        self.ignore_file = ignore_file
+        # Per directory relpath, the rules in force there with their matchers.
+        self.rules = dict()
+        # Per directory path, its (relpath, rules), or False if it is filtered or below a filtered one.
+        self.directories = dict()
+
+    def is_filtered(self, path, is_dir=False):
+        head, name = os.path.split(path)
+        if self.include and self.include.match(name): return False
+        if self.exclude and self.exclude.match(name): return True
+        if self.basepath is None or not self.ignore_file or path == self.basepath: return False
+        directory = self.directories.get(head)
+        if directory is None: directory = self.get_directory(head)
+        if directory is False: return True
+        relpath, rules = directory
+        # Paths outside the basepath have no rules.
+        if rules is None: return False
+        relpath = relpath + '/' + name if relpath else name
+        suffix = '/' if is_dir else ''
+        filtered = self.matches(rules, name + suffix, relpath + suffix)
+        if is_dir: self.directories[path] = False if filtered else (relpath, self.get_rules(relpath))
+        return filtered
 
-def create_index(basepath, includes=[], excludes=[], archive=None):
+    def get_directory(self, path):
+        if path == self.basepath:
+            self.directories[path] = ('', self.get_rules(''))
+        elif not self.is_filtered(path, is_dir=True):
+            relpath = self.relpath(path)
+            self.directories[path] = (relpath, self.get_rules(relpath)) if relpath is not None else (None, None)
+        else:
+            self.directories[path] = False
+        return self.directories[path]
+
+    def relpath(self, path):
+        '''Return the relpath of `path` in the walk, or `None` if it is not below the `basepath`.'''
+        relpath = os.path.relpath(path, self.basepath)
+        return None if relpath == os.pardir or relpath.startswith(os.pardir + os.sep) else relpath
+
+    def matches(self, rules, name, relpath):
+        '''Whether the last of the `rules` (as from `get_rules`) that matches the `name` or `relpath` excludes it.'''
+        rules, names, relpaths = rules
+        last = None
+        for (matcher, positions), subject in ((names, name), (relpaths, relpath)):
+            match = matcher.match(subject) if matcher else None
+            if match and (last is None or positions[match.lastindex - 1] > last): last = positions[match.lastindex - 1]
+        return last is not None and not rules[last][2]
+
+    def get_rules(self, relpath):
+        '''Return the rules in force in the directory `relpath` along with the (matcher, rule positions) for names and
+        for relpaths.'''
+        if relpath not in self.rules:
+            parent_rules = self.get_rules(os.path.dirname(relpath))[0] if relpath else []
+            path = os.path.join(self.basepath, relpath, self.ignore_file)
+            try:
+                rules = parent_rules + read_ignore_file(path, relpath)
+            except EnvironmentError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    sys.stderr.write('Could not read {}: {}\n'.format(path, e))
+                    sys.stderr.flush()
+                rules = parent_rules
+            if relpath and rules is parent_rules:
+                self.rules[relpath] = self.rules[os.path.dirname(relpath)]
+            else:
+                entry = [rules]
+                for anchored in (False, True):
+                    # Later rules come first, so that the first alternative to match is the last rule that does; its
+                    # group tells which one it is.
+                    positions = [i for i in reversed(xrange(len(rules))) if rules[i][0] == anchored]
+                    matcher = re.compile('|'.join('({})'.format(rules[i][1]) for i in positions), re.S) if positions else None
+                    entry.append((matcher, positions))
+                self.rules[relpath] = entry
+        return self.rules[relpath]
+
+def create_index(basepath, includes=[], excludes=[], archive=None, jobs=1, processes=False, full=True, lazy=False,
+                 collect=True, algorithm=hash.DEFAULT_ALGORITHM, block_threshold=None, block_size=hash.BLOCK_SIZE, label=None,
+                 hash_cache=None, mmap_threshold=None):
+    '''Index the files below `basepath`, hashing those not validly cached in the `archive` or the `hash_cache`
+    unless `lazy`. Unless `full`, unchanged directory listings are reused and a watched `archive` is trusted.'''
+    starttime = time.time()
     basepath = os.path.normpath(basepath)
-    fileindex = FileIndex(basepath)
-    filefilter = FileFilter(includes=includes, excludes=excludes)
-    # Read the files in the directory.
-    queue = [basepath]
-    while len(queue) > 0:
-        path = queue.pop()
-        if filefilter.is_filtered(path): continue
+    fileindex = FileIndex(basepath, algorithm)
+    filefilter = FileFilter(includes=includes, excludes=excludes, basepath=basepath)
+    # Listings recorded under different filters are not reusable.
+    filter_key = repr((sorted(includes), sorted(excludes)))
+    if archive and not full and archive.get_algorithm() == algorithm and archive.is_watched(filter_key):
+        # A watcher keeps the archive current, so there is no need to walk.
+        native = (lambda relpath: relpath.encode('utf-8')) if isinstance(basepath, str) else (lambda relpath: relpath)
+        if collect:
+            fileindex.files = [FileDescriptor(native(fd.relpath), fd.mtime, fd.size, digest=fd.digest) for fd in archive.iterate()]
+        metrics.add_time('index', time.time() - starttime)
+        return fileindex
+    hashpool = hash.HashPool(jobs=jobs, processes=processes, algorithm=algorithm, mmap_threshold=mmap_threshold)
+    if archive: archive.set_algorithm(algorithm)
+    # Load the archive once; whatever is left in it after the walk belongs to vanished files and directories.
+    archived_fds = archive.load() if archive else dict()
+    archived_dirs = archive.load_directories() if archive else dict()
+    # Looking up block digests file by file would flush the buffered writes each time.
+    archived_blocks = archive.load_blocks() if archive and block_threshold is not None else dict()
+    # The (mtime, size, inode) of the ignore files by the relpath of their directory, as of the last walk and this one.
+    archived_ignores = json.loads(archive.get_meta('ignore_files') or '{}') if archive else dict()
+    ignores, signatures = dict(), dict()
+    reuse = None
+    if archive and not full and archive.get_meta('filter') == filter_key:
+        reuse = create_listing_reuser(basepath, archived_fds, archived_dirs, archived_ignores, signatures, filefilter.ignore_file)
+    def visited(path, st, listed):
+        relpath = Archive._make_unicode(os.path.relpath(path, basepath))
+        archived_dirs.pop(relpath, None)
+        if archive and listed: archive.insert_directory(relpath, st.st_mtime, st.st_ino)
+        signature = signatures.pop(relpath) if relpath in signatures else ignore_file_signature(path, filefilter.ignore_file)
+        if signature: ignores[relpath] = signature
+    unreadable_dirs = []
+    # Files waiting for their hash, in the order they were found.
+    pending = deque()
+    failed = set()
+    progress = metrics.Progress('[{}] Hashed'.format(label) if label else 'Hashed')
+    try:
+        for path, st in walk(basepath, filefilter, jobs=jobs, unreadable_dirs=unreadable_dirs, reuse=reuse, visited=visited):
+            relpath = os.path.relpath(path, basepath)
+            try:
+                key = Archive._make_unicode(relpath)
+            except ValueError as e:
+                sys.stderr.write('Could not process {}: {}\n'.format(path, e))
+                sys.stderr.flush()
+                continue
+            old_fd = archived_fds.pop(key, None)
+            fd = FileDescriptor(relpath=relpath, mtime=st.st_mtime, size=st.st_size)
+            metrics.count('files_walked')
+            unchanged = old_fd and old_fd.size == fd.size and old_fd.mtime == fd.mtime
+            if unchanged:
+                fd.digest = old_fd.digest
+                metrics.count('archive_hits')
+            else:
+                metrics.count('archive_misses')
+            if fd.digest is None and hash_cache:
+                fd.digest = hash_cache.get(st, algorithm)
+                if fd.digest is not None and archive: archive.insert(fd)
+            # Record the file anyway, so that listings stay complete; it is hashed on demand.
+            if lazy and archive and not unchanged and fd.digest is None: archive.insert(fd)
+            use_blocks = block_threshold is not None and fd.size >= block_threshold and archive is not None
+            if not lazy and (fd.digest is None or use_blocks and archived_blocks.get(key) != (fd.size, fd.mtime)):
+                pending.append((path, fd, old_fd is None, hashpool.submit(path, block_size if use_blocks else None)))
+            if collect: fileindex.files.append(fd)
+            # Keep a bounded backlog, so that the walk does not run arbitrarily far ahead of the hashing.
+            collect_hashes(pending, failed, archive, backlog=4 * hashpool.jobs, progress=progress, hash_cache=hash_cache, algorithm=algorithm)
+        collect_hashes(pending, failed, archive, backlog=0, progress=progress, hash_cache=hash_cache, algorithm=algorithm)
+        progress.finish()
+        if archive:
+            unreadable_relpaths = [Archive._make_unicode(os.path.relpath(path, basepath)) for path in unreadable_dirs]
+            purge_archive(archive, archived_fds.itervalues(), unreadable_relpaths)
+            for relpath in archived_dirs:
+                if relpath not in unreadable_relpaths: archive.delete_directory(relpath)
+            archive.set_meta('filter', filter_key)
+            archive.set_meta('ignore_files', json.dumps(ignores))
+            archive.flush()
+    finally:
+        hashpool.close()
+        metrics.add_time('index', time.time() - starttime)
+    if failed: fileindex.files = [fd for fd in fileindex.files if fd not in failed]
+    return fileindex
+
+def ignore_file_signature(path, ignore_file):
+    '''Return the [mtime, size, inode] of the ignore file in the directory `path`, or `None` if it has none.'''
+    if not ignore_file: return None
+    try:
+        st = os.stat(os.path.join(path, ignore_file))
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+def create_listing_reuser(basepath, archived_fds, archived_dirs, archived_ignores={}, signatures={}, ignore_file=None):
+    '''Create a `reuse` function for `walk` that answers unchanged directories from the archived contents, except
+    below a directory whose ignore file changed from `archived_ignores`. Signatures taken go to `signatures`.'''
+    # Archived relpaths are unicode, but walking a str `basepath` yields str paths.
+    native = (lambda relpath: relpath.encode('utf-8')) if isinstance(basepath, str) else (lambda relpath: relpath)
+    dir_files, dir_subdirs = defaultdict(list), defaultdict(list)
+    for relpath in archived_fds:
+        dir_files[os.path.dirname(relpath) or u'.'].append(native(os.path.basename(relpath)))
+    for relpath in archived_dirs:
+        if relpath != u'.': dir_subdirs[os.path.dirname(relpath) or u'.'].append(native(os.path.basename(relpath)))
+    # Directories whose rules changed; parents are visited before their subdirectories.
+    changed = set()
+    def reuse(path, st):
+        relpath = Archive._make_unicode(os.path.relpath(path, basepath))
+        signature = signatures[relpath] = ignore_file_signature(path, ignore_file)
+        if signature != archived_ignores.get(relpath): changed.add(relpath)
+        ancestor = relpath
+        while True:
+            # Entries the old rules hid are missing from the archived listings.
+            if ancestor in changed: return None
+            if ancestor == u'.': break
+            ancestor = os.path.dirname(ancestor) or u'.'
+        if archived_dirs.get(relpath) != (st.st_mtime, st.st_ino): return None
+        files = [os.path.join(path, name) for name in dir_files.get(relpath, [])]
+        subdirs = [os.path.join(path, name) for name in dir_subdirs.get(relpath, [])]
+        return files, subdirs
+    return reuse
+
+def walk(basepath, filefilter, jobs=1, unreadable_dirs=None, reuse=None, visited=None):
+    '''Yield (path, stat) for every regular file below `basepath` that passes the `filefilter`, listing up to `jobs`
+    directories at once. `reuse` may supply earlier listings, and `visited` is called for every directory.'''
+    if filefilter.is_filtered(basepath, is_dir=True): return
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    submit = lambda path: pool.apply_async(visit_directory, (path, filefilter, reuse)) if pool else None
+    try:
+        # Directories are visited depth-first in the same order regardless of `jobs`; workers list them ahead of time.
+        stack = [(basepath, submit(basepath))]
+        while stack:
+            path, result = stack.pop()
+            try:
+                st, listed, files, subdirs = result.get() if result else visit_directory(path, filefilter, reuse)
+            except EnvironmentError as e:
+                sys.stderr.write('Could not process {}: {}\n'.format(path, e))
+                sys.stderr.flush()
+                if unreadable_dirs is not None: unreadable_dirs.append(path)
+                continue
+            if visited: visited(path, st, listed)
+            for file in files: yield file
+            for subdir in subdirs: stack.append((subdir, submit(subdir)))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def visit_directory(path, filefilter, reuse=None):
+    '''Return (stat, listed, files, subdirs) for the directory `path`, where `listed` tells whether it had to be
+    listed with `scan_directory` or could be answered by `reuse`.'''
+    st = os.stat(path)
+    metrics.count('stat_calls')
+    reused = reuse(path, st) if reuse else None
+    if reused:
+        files, subdirs = [], reused[1]
+        for file in reused[0]:
+            if filefilter.is_filtered(file): continue
+            try:
+                file_st = os.stat(file)
+            except OSError:
+                # Gone since; the archive is purged of it after the walk.
+                continue
+            metrics.count('stat_calls')
+            if stat.S_ISREG(file_st.st_mode): files.append((file, file_st))
+        subdirs = [subdir for subdir in subdirs if not filefilter.is_filtered(subdir, is_dir=True)]
+        metrics.count('directories_reused')
+        return st, False, files, subdirs
+    files, subdirs = scan_directory(path, filefilter)
+    metrics.count('directories_listed')
+    return st, True, files, subdirs
+
+def scan_directory(path, filefilter):
+    '''List the regular files in `path` as (path, stat) pairs along with its subdirectories, skipping filtered entries.'''
+    files, subdirs = [], []
+    if scandir:
+        entries = ((entry.path, entry) for entry in scandir(path))
+    else:
+        entries = ((os.path.join(path, name), None) for name in os.listdir(path))
+    num_stats = 0
+    for child, entry in entries:
         try:
-            if os.path.isdir(path):
-                for child in os.listdir(path): queue.append(os.path.join(path, child))
+            if entry:
+                if entry.is_dir():
+                    if not filefilter.is_filtered(child, is_dir=True): subdirs.append(child)
+                elif entry.is_file() and not filefilter.is_filtered(child):
+                    files.append((child, entry.stat()))
+                    num_stats += 1
             else:
-                fd = create_descriptor(path, basepath)
-                old_fd = archive[fd.relpath] if archive else None
-                if not old_fd:
-                    sys.stdout.write('Calculating SHA256 for {}... '.format(path))
-                    starttime = time.time()
-                    fd.sha256 = sha256 = hash.sha256(path)
-                    sys.stdout.write('({})\n'.format(datetime.timedelta(seconds=time.time()-starttime)))
-                    sys.stdout.flush()
-                    if archive: archive.insert(fd)
-                elif old_fd.size != fd.size or old_fd.mtime != fd.mtime:
-                    sys.stdout.write('Calculating SHA256 for {}... '.format(path))
-                    starttime = time.time()
-                    fd.sha256 = sha256 = hash.sha256(path)
-                    sys.stdout.write('({})\n'.format(datetime.timedelta(seconds=time.time()-starttime)))
-                    sys.stdout.flush()
-                    if archive: archive.update(fd)
-                else:
-                    fd.sha256 = old_fd.sha256
-                fileindex.files.append(fd)
+                st = os.stat(child)
+                num_stats += 1
+                if stat.S_ISDIR(st.st_mode):
+                    if not filefilter.is_filtered(child, is_dir=True): subdirs.append(child)
+                elif stat.S_ISREG(st.st_mode) and not filefilter.is_filtered(child): files.append((child, st))
+        except EnvironmentError as e:
+            sys.stderr.write('Could not process {}: {}\n'.format(child, e))
+            sys.stderr.flush()
+    metrics.count('stat_calls', num_stats)
+    return files, subdirs
+
+def purge_archive(archive, vanished_fds, unreadable_dirs=[]):
+    '''Delete the `vanished_fds` from the `archive`, except for those below any of the `unreadable_dirs`.'''
+    prefixes = tuple(d + os.sep for d in unreadable_dirs if d != '.')
+    keep_all = '.' in unreadable_dirs
+    for fd in vanished_fds:
+        if keep_all or (prefixes and fd.relpath.startswith(prefixes)): continue
+        archive.delete(fd)
+
+def hash_files(fds, basepath, archive=None, jobs=1, processes=False, algorithm=hash.DEFAULT_ALGORITHM, hash_cache=None):
+    '''Calculate the hashes of the `fds` below `basepath` and store them in the `archive` and `hash_cache`. Returns
+    the `fds` that could be hashed.'''
+    hashpool = hash.HashPool(jobs=jobs, processes=processes, algorithm=algorithm)
+    pending = deque()
+    failed = set()
+    progress = metrics.Progress('Hashed')
+    try:
+        for fd in fds:
+            path = os.path.join(basepath, fd.relpath)
+            pending.append((path, fd, False, hashpool.submit(path)))
+            collect_hashes(pending, failed, archive, backlog=4 * hashpool.jobs, progress=progress, hash_cache=hash_cache, algorithm=algorithm)
+        collect_hashes(pending, failed, archive, backlog=0, progress=progress, hash_cache=hash_cache, algorithm=algorithm)
+        progress.finish()
+        if archive: archive.flush()
+    finally:
+        hashpool.close()
+    return [fd for fd in fds if fd not in failed]
+
+def find_duplicates(fileindex, archive=None, jobs=1, processes=False, sample_size=hash.SAMPLE_SIZE, hash_cache=None):
+    '''Group the files of the `fileindex` that have the same content by their hash, leaving out unique files. Only
+    files of the same size whose samples collide are fully hashed.'''
+    size_groups = defaultdict(list)
+    for fd in fileindex.files: size_groups[fd.size].append(fd)
+    candidates, sampled_fds = [], []
+    for size, fds in size_groups.iteritems():
+        if len(fds) < 2 or all(fd.digest is not None for fd in fds): continue
+        # Samples of small files would cover the whole file anyway.
+        if size <= 2 * sample_size: candidates += [fd for fd in fds if fd.digest is None]
+        else: sampled_fds += fds
+    sample_groups = defaultdict(list)
+    paths = [os.path.join(fileindex.basepath, fd.relpath) for fd in sampled_fds]
+    for fd, sample in zip(sampled_fds, hash_samples(paths, jobs, processes, sample_size, fileindex.algorithm)):
+        if sample is not None: sample_groups[sample].append(fd)
+    for fds in sample_groups.itervalues():
+        if len(fds) > 1: candidates += [fd for fd in fds if fd.digest is None]
+    hash_files(candidates, fileindex.basepath, archive, jobs, processes, fileindex.algorithm, hash_cache)
+
+    hash_groups = defaultdict(list)
+    for fd in fileindex.files:
+        if fd.digest is not None: hash_groups[fd.digest].append(fd)
+    return dict((h, fds) for h, fds in hash_groups.iteritems() if len(fds) > 1)
+
+def hash_samples(paths, jobs=1, processes=False, sample_size=hash.SAMPLE_SIZE, algorithm=hash.DEFAULT_ALGORITHM):
+    '''Return the sample hashes of the `paths` in order, with `None` for files that could not be read.'''
+    hashpool = hash.HashPool(jobs=jobs, processes=processes, algorithm=algorithm)
+    try:
+        results = [hashpool.apply(hash.sample, path, sample_size, algorithm) for path in paths]
+        samples = []
+        for path, result in zip(paths, results):
+            try:
+                samples.append(result.get())
+            except (EnvironmentError, SystemError) as e:
+                sys.stderr.write('Could not process {}: {}\n'.format(path, e))
+                sys.stderr.flush()
+                samples.append(None)
+        return samples
+    finally:
+        hashpool.close()
+
+def collect_hashes(pending, failed, archive, backlog, progress=None, hash_cache=None, algorithm=hash.DEFAULT_ALGORITHM):
+    '''Store finished hashes of `pending` files in order, waiting only while more than `backlog` are pending.'''
+    while pending and (len(pending) > backlog or pending[0][3].ready()):
+        path, fd, is_new, result = pending.popleft()
+        try:
+            fd.digest, elapsedtime, blocks = result.get()
         except (EnvironmentError, SystemError) as e:
             sys.stderr.write('Could not process {}: {}\n'.format(path, e))
             sys.stderr.flush()
-    return fileindex
+            failed.add(fd)
+            continue
+        metrics.count('files_hashed')
+        metrics.count('bytes_hashed', fd.size)
+        metrics.add_time('hash', elapsedtime)
+        if progress: progress.add(fd.size)
+        if archive:
+            if is_new: archive.insert(fd)
+            else: archive.update(fd)
+            if blocks: archive.insert_blocks(fd, *blocks)
+        if hash_cache: hash_cache.put_path(path, fd.size, fd.mtime, algorithm, fd.digest)
 
 def split_path(path):
     path = os.path.normpath(path)
@@ -207,40 +947,89 @@ def split_path(path):
     l.reverse()
     return l
 
-def create_descriptor(path, basepath):
-    if not os.path.isfile(path): raise ValueError('Not a file: {}'.format(path))
-    stat = os.stat(path)
-    return FileDescriptor(relpath=os.path.relpath(path, basepath), mtime=stat.st_mtime, size=stat.st_size)
-
-def fuzzy_match_names(fds1, fds2):
+def fuzzy_match_names(fds1, fds2, max_candidates=32, max_pairs=1000000):
+    '''Pair up files of `fds1` and `fds2`, which all have the same content, such that paired paths are similar.
+    Returns the pairs and the sets of unpaired files of either side.'''
     result = []
-    matches = []
-    remnant_fds1 = set(fds1)
-    remnant_fds2 = set(fds2)
-    for fd1 in fds1:
-        for fd2 in fds2:
-            matches.append((fd1, fd2, difflib.SequenceMatcher(None, fd1.relpath, fd2.relpath).ratio()))
-    matches.sort(cmp=lambda a, b: a - b, key=lambda e: e[2], reverse=True)
-    while remnant_fds1 and remnant_fds2:
-        while True:
-            fd1, fd2, ratio = matches.pop()
-            if ratio == 0: break
-            if fd1 in remnant_fds1 and fd2 in remnant_fds2:
-                remnant_fds1.discard(fd1)
-                remnant_fds2.discard(fd2)
-                break
-        result.append((fd1, fd2))
-    return result, remnant_fds1, remnant_fds2
-
-def copy(source_path, target_path, overwrite=False):
+    remnant_fds1 = list(fds1)
+    remnant_fds2 = list(fds2)
+    for key in (lambda fd: (os.path.basename(os.path.dirname(fd.relpath)), os.path.basename(fd.relpath)),
+                lambda fd: os.path.basename(fd.relpath)):
+        if not remnant_fds1 or not remnant_fds2: break
+        keyed_fds2 = defaultdict(deque)
+        for fd2 in remnant_fds2: keyed_fds2[key(fd2)].append(fd2)
+        unmatched_fds1 = []
+        for fd1 in remnant_fds1:
+            candidates = keyed_fds2.get(key(fd1))
+            if candidates: result.append((fd1, candidates.popleft()))
+            else: unmatched_fds1.append(fd1)
+        remnant_fds1 = unmatched_fds1
+        remnant_fds2 = [fd2 for fds in keyed_fds2.itervalues() for fd2 in fds]
+
+    if remnant_fds1 and remnant_fds2:
+        # Score candidate pairs by shared path components, looking up the rarest components first.
+        components2 = [set(fd2.relpath.split(os.sep)) for fd2 in remnant_fds2]
+        component_index = defaultdict(list)
+        for i2, components in enumerate(components2):
+            for component in components: component_index[component].append(i2)
+        scored_pairs = []
+        for i1, fd1 in enumerate(remnant_fds1):
+            if len(scored_pairs) >= max_pairs: break
+            components1 = set(fd1.relpath.split(os.sep))
+            candidates = set()
+            for component in sorted(components1, key=lambda c: len(component_index.get(c, ()))):
+                candidates.update(component_index.get(component, ())[:max_candidates - len(candidates)])
+                if len(candidates) >= max_candidates: break
+            for i2 in candidates:
+                scored_pairs.append((len(components1 & components2[i2]), i1, i2))
+        scored_pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+        paired1, paired2 = set(), set()
+        for score, i1, i2 in scored_pairs:
+            if i1 in paired1 or i2 in paired2: continue
+            paired1.add(i1)
+            paired2.add(i2)
+            result.append((remnant_fds1[i1], remnant_fds2[i2]))
+        remnant_fds1 = [fd1 for i1, fd1 in enumerate(remnant_fds1) if i1 not in paired1]
+        remnant_fds2 = [fd2 for i2, fd2 in enumerate(remnant_fds2) if i2 not in paired2]
+
+    for fd1, fd2 in zip(remnant_fds1, remnant_fds2): result.append((fd1, fd2))
+    n = min(len(remnant_fds1), len(remnant_fds2))
+    return result, set(remnant_fds1[n:]), set(remnant_fds2[n:])
+
+def copy(source_path, target_path, overwrite=False, digest=None, algorithm=hash.DEFAULT_ALGORITHM):
+    '''Copy a file, creating the target directory as needed. If a `digest` (of the given `algorithm`) is given, the
+    data is verified against it while copying, raising a `transfer.VerificationError` on a mismatch.'''
     if not overwrite and os.path.exists(target_path):
         raise OSError('Cannot copy {} to {}: target file exists'.format(source_path, target_path))
     if os.path.isdir(target_path):
         raise OSError('Cannot copy {} to {}: target is an existing directory'.format(source_path, target_path))
     target_dir = os.path.dirname(target_path)
     if not os.path.exists(target_dir): os.makedirs(target_dir)
-    if overwrite: os.remove(target_path)
-    shutil.copy(source_path, target_path)
+    if overwrite and os.path.lexists(target_path): os.remove(target_path)
+    if digest is not None: transfer.copyfile_verified(source_path, target_path, digest, algorithm)
+    else: transfer.copyfile(source_path, target_path)
+    shutil.copymode(source_path, target_path)
+
+def link(source_path, target_path, overwrite=False, mode='hardlink'):
+    '''Make `target_path` a hardlink or, with mode `reflink`, a reflinked copy of `source_path`. The link is made next
+    to the target and renamed over it, so that an overwritten target is never lost.'''
+    if not overwrite and os.path.exists(target_path):
+        raise OSError('Cannot link {} to {}: target file exists'.format(source_path, target_path))
+    if os.path.isdir(target_path):
+        raise OSError('Cannot link {} to {}: target is an existing directory'.format(source_path, target_path))
+    target_dir = os.path.dirname(target_path)
+    if target_dir and not os.path.exists(target_dir): os.makedirs(target_dir)
+    temp_path = target_path + '.pysync-link'
+    try:
+        if mode == 'reflink':
+            transfer.reflink(source_path, temp_path)
+            shutil.copymode(source_path, temp_path)
+        else:
+            os.link(source_path, temp_path)
+        os.rename(temp_path, target_path)
+    except:
+        if os.path.lexists(temp_path): os.remove(temp_path)
+        raise
 
 def move(source_path, target_path, overwrite=False):
     if not overwrite and os.path.exists(target_path):
@@ -0,0 +1,242 @@
+import errno, os, sys, time, datetime, core, hash, metrics, transfer, Queue
+from multiprocessing.pool import ThreadPool
+
+class Operation(object):
+    '''A copy, move or deletion of a sync, producing `target_path`, along with the `archive` update that records it.
+    Copies may come from a `local_path` or by blocks, and are refused if the source changed since `mtime`.'''
+    COPY, MOVE, DELETE = 'copy', 'move', 'delete'
+
+    def __init__(self, kind, source_path, target_path, archive, relpath=None, digest=None, size=0, old_fd=None, overwrite=False,
+                 blocks=None, old_blocks=None, mtime=None, target_fd=None):
+        self.kind = kind
+        self.source_path = source_path
+        self.target_path = target_path
+        self.archive = archive
+        self.relpath = relpath
+        self.digest = digest
+        self.size = size
+        self.old_fd = old_fd
+        self.overwrite = overwrite
+        self.blocks = blocks
+        self.old_blocks = old_blocks
+        self.mtime = mtime
+        # The indexed target file that `old_blocks` describe.
+        self.target_fd = target_fd
+        self.local_path = self.local_fd = self.local_mode = None
+        self.delta = self.local = self.verified = False
+        self.transferred = 0
+
+    def key(self):
+        '''Identify the operation in a `plan.Journal`.'''
+        return repr((self.kind, self.source_path, self.target_path))
+
+    def describe(self):
+        if self.kind == Operation.DELETE: return 'Deleting {}...'.format(self.target_path)
+        elif self.kind == Operation.MOVE: return 'Moving {} to {}...'.format(self.source_path, self.target_path)
+        else: return 'Copying {} to {}...'.format(self.source_path, self.target_path)
+
+    def perform(self, verify=False, algorithm=hash.DEFAULT_ALGORITHM):
+        '''Carry out the operation on the file system and return the `os.stat` of the resulting file, if any. With
+        `verify`, copied data is checked against the `digest` (made with `algorithm`) on the way.'''
+        if self.kind == Operation.DELETE:
+            os.remove(self.target_path)
+            return None
+        elif self.kind == Operation.MOVE:
+            core.move(self.source_path, self.target_path, overwrite=self.overwrite)
+        elif self.local_path and self.is_local_unchanged():
+            self.local = True
+            self.transferred = 0
+            try:
+                if self.local_mode == 'hardlink': core.link(self.local_path, self.target_path, overwrite=self.overwrite)
+                else: core.copy(self.local_path, self.target_path, overwrite=self.overwrite,
+                                digest=self.digest if verify else None, algorithm=algorithm)
+                self.verified = verify and self.local_mode != 'hardlink' and self.digest is not None
+            except transfer.VerificationError:
+                # The local file is not what the archive says; retry from the source.
+                self.local_path, self.local = None, False
+                raise
+        elif self.can_delta():
+            self.check_source(os.stat(self.source_path))
+            self.delta = True
+            self.transferred = transfer.delta_copy(self.source_path, self.target_path, self.blocks[1], self.old_blocks[1],
+                                                   self.blocks[0], algorithm if verify else None)
+            self.verified = verify
+        else:
+            self.check_source(os.stat(self.source_path))
+            core.copy(self.source_path, self.target_path, overwrite=self.overwrite,
+                      digest=self.digest if verify else None, algorithm=algorithm)
+            self.transferred = self.size
+            self.verified = verify and self.digest is not None
+        return os.stat(self.target_path)
+
+    def check_source(self, st):
+        # Otherwise, the target would be recorded with a digest of contents it does not have.
+        if self.mtime is not None and (st.st_size != self.size or st.st_mtime != self.mtime):
+            raise OSError(errno.ESTALE, 'Changed since it was indexed', self.source_path)
+
+    def is_local_unchanged(self):
+        try:
+            st = os.stat(self.local_path)
+        except OSError:
+            return False
+        return st.st_size == self.local_fd.size and st.st_mtime == self.local_fd.mtime
+
+    def can_delta(self):
+        '''Whether the target can be updated block by block, which requires matching block sizes and a file that is not
+        shared with other hardlinks and is still as indexed.'''
+        if not (self.overwrite and self.blocks and self.old_blocks and self.blocks[0] == self.old_blocks[0] and self.target_fd):
+            return False
+        try:
+            st = os.stat(self.target_path)
+        except OSError:
+            return False
+        return st.st_nlink == 1 and st.st_size == self.target_fd.size and st.st_mtime == self.target_fd.mtime
+
+    def record(self, st):
+        if self.kind == Operation.MOVE: self.archive.rename_blocks(self.old_fd.relpath, self.relpath)
+        if self.old_fd: self.archive.delete(self.old_fd)
+        if st:
+            fd = core.FileDescriptor(relpath=self.relpath, mtime=st.st_mtime, size=st.st_size, digest=self.digest)
+            self.archive.insert(fd)
+            if self.kind == Operation.COPY and self.blocks: self.archive.insert_blocks(fd, *self.blocks)
+
+def attempt(operation, verify=False, retries=0, algorithm=hash.DEFAULT_ALGORITHM):
+    '''Perform the `operation`, retrying copies that fail verification up to `retries` times. Returns the operation,
+    the `os.stat` of its result and the error it failed with, if any.'''
+    for trial in range(retries + 1):
+        try:
+            return operation, operation.perform(verify, algorithm), None
+        except transfer.VerificationError as e:
+            error = e
+            # Clear the way for the next trial; the last one's result is left for inspection.
+            if trial < retries:
+                try: os.remove(operation.target_path)
+                except OSError: pass
+        except Exception as e:
+            # Pool callbacks only see results, so a worker must never raise.
+            return operation, None, e
+    return operation, None, error
+
+class Executor:
+    '''Runs `Operation`s: moves in order first, then deletions and copies on worker threads, with a separate pool for
+    files of at least `large_size` bytes. Archive updates are issued from the calling thread.'''
+    def __init__(self, small_jobs=8, large_jobs=2, large_size=16 * 1024 * 1024, dryrun=False, verify=False, retries=2,
+                 algorithm=hash.DEFAULT_ALGORITHM, local=None, journal=None, hash_cache=None):
+        if verify: hash.new(algorithm)
+        self.small_jobs = max(1, small_jobs)
+        self.large_jobs = max(1, large_jobs)
+        self.large_size = large_size
+        self.dryrun = dryrun
+        self.verify = verify
+        self.retries = retries
+        self.algorithm = algorithm
+        self.local = local
+        self.journal = journal
+        self.hash_cache = hash_cache
+
+    def run(self, operations):
+        if self.journal:
+            num_operations = len(operations)
+            operations = [op for op in operations if op.key() not in self.journal]
+            if len(operations) < num_operations:
+                print 'Skipping {} operations done in an earlier run.'.format(num_operations - len(operations))
+        for operation in operations: print operation.describe()
+        if self.dryrun or not operations: return
+        starttime = time.time()
+        self.num_files = self.num_bytes = 0
+        self.delta_files = self.delta_bytes = self.delta_size = 0
+        self.local_files = self.local_bytes = 0
+        self.verified_files = 0
+        self.mismatches = []
+
+        # Create the target directories first, so that concurrent copies do not race to do so.
+        directories = set(os.path.dirname(op.target_path) for op in operations if op.kind != Operation.DELETE)
+        for directory in sorted(directories):
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except EnvironmentError as e:
+                    sys.stderr.write('Could not create {}: {}\n'.format(directory, e))
+                    sys.stderr.flush()
+
+        for operation in operations:
+            if operation.kind == Operation.MOVE: self.finish(*attempt(operation))
+        if self.local: self.find_local_sources(operations)
+
+        small_pool, large_pool = ThreadPool(self.small_jobs), ThreadPool(self.large_jobs)
+        done = Queue.Queue()
+        outstanding = 0
+        try:
+            for operation in operations:
+                if operation.kind == Operation.MOVE: continue
+                is_large = operation.kind == Operation.COPY and operation.size >= self.large_size
+                (large_pool if is_large else small_pool).apply_async(attempt, (operation, self.verify, self.retries, self.algorithm),
+                                                                   callback=done.put)
+                outstanding += 1
+                # Finish operations as they complete, and do not queue up arbitrarily many.
+                while outstanding > 0 and (outstanding >= 4 * (self.small_jobs + self.large_jobs) or not done.empty()):
+                    self.finish(*done.get())
+                    outstanding -= 1
+            while outstanding > 0:
+                self.finish(*done.get())
+                outstanding -= 1
+        finally:
+            for pool in (small_pool, large_pool):
+                pool.close()
+                pool.join()
+
+        elapsedtime = time.time() - starttime
+        metrics.add_time('copy', elapsedtime)
+        print 'Transferred {} files ({:.1f} MB) in {}: {:.1f} files/s, {:.1f} MB/s.'.format(
+            self.num_files, self.num_bytes / 1e6, datetime.timedelta(seconds=elapsedtime),
+            self.num_files / max(elapsedtime, 1e-6), self.num_bytes / 1e6 / max(elapsedtime, 1e-6))
+        if self.local_files:
+            print 'Took {} files ({:.1f} MB) from identical files on the target side.'.format(self.local_files, self.local_bytes / 1e6)
+        if self.delta_files:
+            print 'Delta-copied {} files: {:.1f} MB transferred for {:.1f} MB of file data.'.format(
+                self.delta_files, self.delta_bytes / 1e6, self.delta_size / 1e6)
+        if self.verify: self.report_verification()
+
+    def report_verification(self):
+        # Copies without a digest to check against and hardlinks are not verified.
+        print 'Verified {} files, {} not verified, {} failed verification{}'.format(
+            self.verified_files, self.num_files - self.verified_files, len(self.mismatches), ':' if self.mismatches else '.')
+        for operation in self.mismatches: print '\t{}'.format(operation.target_path)
+
+    def find_local_sources(self, operations):
+        '''Point copies at a file with the same digest in their archive's tree, unless the remaining `operations` touch
+        it. Moves are done by then, so their results can serve as well.'''
+        touched = set(os.path.normpath(op.target_path) for op in operations if op.kind != Operation.MOVE)
+        for operation in operations:
+            if operation.kind != Operation.COPY or operation.digest is None: continue
+            fd = operation.archive.find(operation.digest)
+            if not fd: continue
+            path = os.path.normpath(os.path.join(os.path.dirname(operation.archive.path), fd.relpath))
+            if path in touched: continue
+            operation.local_path, operation.local_fd, operation.local_mode = path, fd, self.local
+
+    def finish(self, operation, st, error):
+        if isinstance(error, transfer.VerificationError): self.mismatches.append(operation)
+        if error:
+            if operation.kind == Operation.DELETE:
+                sys.stderr.write('Could not delete {}: {}\n'.format(operation.target_path, error))
+            else:
+                sys.stderr.write('Could not {} {} to {}: {}\n'.format(operation.kind, operation.source_path, operation.target_path, error))
+            sys.stderr.flush()
+            return
+        operation.record(st)
+        if self.hash_cache and st and operation.digest is not None: self.hash_cache.put(st, self.algorithm, operation.digest)
+        if self.journal: self.journal.record(operation.key())
+        if operation.kind == Operation.COPY:
+            self.num_files += 1
+            self.num_bytes += operation.transferred
+            if operation.verified: self.verified_files += 1
+            metrics.count('files_copied')
+            metrics.count('bytes_copied', operation.transferred)
+            if operation.local:
+                self.local_files += 1
+                self.local_bytes += st.st_size
+            if operation.delta:
+                self.delta_files += 1
+                self.delta_bytes += operation.transferred
+                self.delta_size += st.st_size
@@ -1,10 +1,147 @@
-import hashlib
+import hashlib, mmap, os, time
+from multiprocessing.pool import Pool, ThreadPool
 
-def sha256(path):
-    m = hashlib.sha256()
+# Bytes read from both the head and the tail of a file for its sample hash.
+SAMPLE_SIZE = 64 * 1024
+# Bytes hashed per read.
+BUFFER_SIZE = 1024 * 1024
+# A file size from which mapping files into memory pays off. Mapping is opt-in: a mapped file that is truncated while
+# it is hashed kills the process with SIGBUS.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# Bytes per block for block-level digests.
+BLOCK_SIZE = 1024 * 1024
+
+DEFAULT_ALGORITHM = 'sha256'
+# Digest algorithms by name, as factories of hashlib-style objects.
+ALGORITHMS = {}
+
+def register(name, factory):
+    ALGORITHMS[name] = factory
+
+for name in ('md5', 'sha1', 'sha256', 'sha512'):
+    register(name, getattr(hashlib, name))
+if hasattr(hashlib, 'blake2b'):
+    register('blake2b', hashlib.blake2b)
+else:
+    try:
+        import pyblake2
+        register('blake2b', pyblake2.blake2b)
+    except ImportError:
+        pass
+try:
+    import blake3
+    register('blake3', blake3.blake3)
+except ImportError:
+    pass
+try:
+    import xxhash
+    register('xxh64', xxhash.xxh64)
+    if hasattr(xxhash, 'xxh3_128'): register('xxh128', xxhash.xxh3_128)
+except ImportError:
+    pass
+
+def new(algorithm=DEFAULT_ALGORITHM):
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown hash algorithm {} (available: {})'.format(algorithm, ', '.join(sorted(ALGORITHMS))))
+    return ALGORITHMS[algorithm]()
+
+def digest(path, algorithm=DEFAULT_ALGORITHM, buffer_size=BUFFER_SIZE, mmap_threshold=None):
+    '''Return the binary digest of the file. Given an `mmap_threshold`, files of at least that many bytes are hashed
+    from a memory map instead of read.'''
+    m = new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and size >= max(mmap_threshold, 1):
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, buffer_size):
+                    m.update(buffer(mapped, offset, buffer_size))
+            finally:
+                mapped.close()
+        else:
+            while True:
+                data = f.read(buffer_size)
+                if not data: break
+                m.update(data)
+    return m.digest()
+
+def digest_blocks(path, algorithm=DEFAULT_ALGORITHM, block_size=BLOCK_SIZE):
+    '''Return the binary digest of the file along with the digests of its `block_size` blocks, from a single read.'''
+    m = new(algorithm)
+    blocks = []
     with open(path, 'rb') as f:
         while True:
-            data = f.read(4096)
+            data = f.read(block_size)
             if not data: break
             m.update(data)
-    return m.hexdigest()
+            blocks.append(block_digest(data, algorithm))
+    return m.digest(), blocks
+
+def block_digest(data, algorithm=DEFAULT_ALGORITHM):
+    m = new(algorithm)
+    m.update(data)
+    return m.digest()
+
+def sha256(path):
+    return digest(path, 'sha256').encode('hex')
+
+def timed_digest(path, algorithm=DEFAULT_ALGORITHM, block_size=None, mmap_threshold=None):
+    '''Return the binary digest of the file, the seconds it took, and, if a `block_size` is given, the
+    (block_size, digests) of its blocks.'''
+    starttime = time.time()
+    if block_size:
+        digest_, blocks = digest_blocks(path, algorithm, block_size)
+        return digest_, time.time() - starttime, (block_size, blocks)
+    digest_ = digest(path, algorithm, mmap_threshold=mmap_threshold)
+    return digest_, time.time() - starttime, None
+
+def sample(path, sample_size=SAMPLE_SIZE, algorithm=DEFAULT_ALGORITHM):
+    '''Hash the size and the first and last `sample_size` bytes of the file, to rule out duplicates cheaply.'''
+    m = new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        m.update(str(size))
+        m.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            m.update(f.read(sample_size))
+    return m.digest()
+
+class HashPool:
+    '''Hashes files with the given `algorithm` on `jobs` worker threads (or processes), or inline if `jobs` is 1.
+    Files of at least `mmap_threshold` bytes, if given, are memory-mapped.'''
+    def __init__(self, jobs=1, processes=False, algorithm=DEFAULT_ALGORITHM, mmap_threshold=None):
+        new(algorithm)
+        self.jobs = max(1, jobs)
+        self.algorithm = algorithm
+        self.mmap_threshold = mmap_threshold
+        self.pool = None
+        if self.jobs > 1:
+            self.pool = Pool(self.jobs) if processes else ThreadPool(self.jobs)
+
+    def submit(self, path, block_size=None):
+        return self.apply(timed_digest, path, self.algorithm, block_size, self.mmap_threshold)
+
+    def apply(self, func, *args):
+        if self.pool: return self.pool.apply_async(func, args)
+        return InlineResult(func, *args)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class InlineResult:
+    '''Mimics `multiprocessing.pool.AsyncResult` for a job computed on the spot.'''
+    def __init__(self, func, *args):
+        self.value = self.error = None
+        try: self.value = func(*args)
+        except Exception as e: self.error = e
+
+    def ready(self):
+        return True
+
+    def get(self):
+        if self.error: raise self.error
+        return self.value
@@ -0,0 +1,90 @@
+import json, os, sys, threading, time
+from collections import defaultdict
+
+# Counters and timers (in seconds) of the current run by name. Worker threads update them, hence the lock.
+counters = defaultdict(int)
+timers = defaultdict(float)
+lock = threading.Lock()
+
+# Rates derived for the summary as (name, counter, timer, scale, unit).
+RATES = [
+    ('hash throughput', 'bytes_hashed', 'hash', 1e6, 'MB/s'),
+    ('copy throughput', 'bytes_copied', 'copy', 1e6, 'MB/s'),
+    ('index rate', 'files_walked', 'index', 1, 'files/s'),
+]
+
+def count(name, n=1):
+    with lock: counters[name] += n
+
+def add_time(name, seconds):
+    with lock: timers[name] += seconds
+
+class timer(object):
+    '''Add the time spent in a `with` block to the timer `name`.'''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.starttime = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.time() - self.starttime)
+
+def reset():
+    with lock:
+        counters.clear()
+        timers.clear()
+
+def rates():
+    return [(name, counters[counter] / scale / timers[timer_name], unit)
+            for name, counter, timer_name, scale, unit in RATES if timers.get(timer_name) and counter in counters]
+
+def summary():
+    '''Return the counters, timers and derived rates as a table.'''
+    rows = [(name, str(value)) for name, value in sorted(counters.items())]
+    rows += [(name + ' time', '{:.3f} s'.format(value)) for name, value in sorted(timers.items())]
+    rows += [(name, '{:.1f} {}'.format(value, unit)) for name, value, unit in rates()]
+    width = max([len(name) for name, _ in rows] + [0])
+    return '\n'.join('{}  {}'.format(name.ljust(width), value) for name, value in rows)
+
+def write(path):
+    '''Write the metrics to `path`, as JSON if it ends with .json and in the Prometheus text format otherwise. The file
+    is replaced only once complete, as the node exporter's textfile collector requires.'''
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump({'counters': counters, 'timers': timers, 'rates': dict((name, value) for name, value, _ in rates())},
+                      f, indent=2, sort_keys=True)
+        else:
+            for name, value in sorted(counters.items()):
+                f.write('pysync_{}_total {}\n'.format(name, value))
+            for name, value in sorted(timers.items()):
+                f.write('pysync_{}_seconds_total {!r}\n'.format(name, value))
+    os.rename(temp_path, path)
+
+class Progress(object):
+    '''Reports how many files and bytes were processed in a status line, at most every `interval` seconds instead of
+    once per file. On a terminal, the line is updated in place.'''
+    def __init__(self, label, interval=1.0, stream=None):
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.files = self.bytes = 0
+        self.starttime = self.last_report = time.time()
+
+    def add(self, num_bytes):
+        self.files += 1
+        self.bytes += num_bytes
+        if time.time() - self.last_report >= self.interval: self.report()
+
+    def report(self, end=None):
+        self.last_report = time.time()
+        elapsedtime = max(self.last_report - self.starttime, 1e-6)
+        line = '{} {} files ({:.1f} MB, {:.1f} MB/s)'.format(self.label, self.files, self.bytes / 1e6, self.bytes / 1e6 / elapsedtime)
+        self.stream.write(('\r' + line + '\033[K' + (end or '')) if self.tty else line + '\n')
+        self.stream.flush()
+
+    def finish(self):
+        if self.files: self.report(end='\n')
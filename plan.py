@@ -0,0 +1,82 @@
+import binascii, core, json, os
+
+# Plan files hold the outcome of a sync comparison or of a clean duplicate search, so that it can be carried out later
+# and non-interactively. They are JSON lines: a header describing the plan, then one line per change or per group of
+# duplicates, with files as [relpath, size, mtime, hexdigest].
+
+def encode_fd(fd):
+    return [core.Archive._make_unicode(fd.relpath), fd.size, fd.mtime, fd.hexdigest]
+
+def decode_fd(entry):
+    relpath, size, mtime, hexdigest = entry
+    return core.FileDescriptor(relpath.encode('utf-8'), mtime, size, digest=binascii.unhexlify(hexdigest) if hexdigest is not None else None)
+
+def journal_path(path):
+    return path + '.done'
+
+def write_plan(path, header, entries):
+    '''Write the `header` and `entries` to the plan file at `path`, replacing it only once complete. The journal of
+    the plan it replaces is removed first.'''
+    if os.path.exists(journal_path(path)): os.remove(journal_path(path))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        for entry in [header] + entries:
+            f.write(json.dumps(entry))
+            f.write('\n')
+    os.rename(temp_path, path)
+
+def write_sync_plan(path, source, target, algorithm, changeset):
+    entries = [{'change': 'new', 'fd': encode_fd(fd)} for fd in changeset.new_files]
+    entries += [{'change': 'removed', 'fd': encode_fd(fd)} for fd in changeset.removed_files]
+    entries += [{'change': 'changed', 'source': encode_fd(new), 'target': encode_fd(old)} for new, old in changeset.file_changes]
+    entries += [{'change': 'moved', 'source': encode_fd(new), 'target': encode_fd(old)} for new, old in changeset.file_moves]
+    write_plan(path, {'plan': 'sync', 'source': source, 'target': target, 'algorithm': algorithm}, entries)
+
+def write_clean_plan(path, directory, algorithm, hash_dict):
+    entries = [{'duplicates': map(encode_fd, fds)} for fds in hash_dict.itervalues()]
+    write_plan(path, {'plan': 'clean', 'directory': directory, 'algorithm': algorithm}, entries)
+
+def read_plan(path):
+    '''Return the header of the plan file and its contents: a `ChangeSet` for sync plans, and lists of duplicate
+    `FileDescriptor`s keyed by their digest for clean plans.'''
+    with open(path) as f:
+        header = json.loads(f.readline())
+        for key in ('source', 'target', 'directory'):
+            if key in header: header[key] = header[key].encode('utf-8')
+        if header['plan'] == 'sync':
+            changeset = core.ChangeSet()
+            for line in f:
+                entry = json.loads(line)
+                if entry['change'] == 'new': changeset.new_files.append(decode_fd(entry['fd']))
+                elif entry['change'] == 'removed': changeset.removed_files.append(decode_fd(entry['fd']))
+                elif entry['change'] == 'changed': changeset.file_changes.append((decode_fd(entry['source']), decode_fd(entry['target'])))
+                elif entry['change'] == 'moved': changeset.file_moves.append((decode_fd(entry['source']), decode_fd(entry['target'])))
+            return header, changeset
+        elif header['plan'] == 'clean':
+            hash_dict = dict()
+            for line in f:
+                fds = map(decode_fd, json.loads(line)['duplicates'])
+                hash_dict[fds[0].digest] = fds
+            return header, hash_dict
+        raise ValueError('Unknown plan {} in {}'.format(header['plan'], path))
+
+class Journal:
+    '''Records the operations of a plan that are done, one key per line, so that a rerun after a crash can skip them.'''
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.rstrip('\n') for line in f)
+        self.file = open(path, 'a')
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def record(self, key):
+        self.file.write(key + '\n')
+        self.file.flush()
+        self.done.add(key)
+
+    def close(self):
+        self.file.close()
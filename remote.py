@@ -0,0 +1,441 @@
+import binascii, datetime, errno, hmac, json, os, re, socket, struct, sys, threading, time, zlib, Queue, core, executor, hash, metrics, transfer
+
+# Served directories are given as HOST[:PORT]:PATH, or as [SOCKET]:PATH for an agent on a Unix socket. As with scp,
+# a local path with a slash before its first colon is never taken for one.
+LOCATION_REGEX = re.compile(r'^(?:\[(?P<socket>[^\]]+)\]|(?P<host>[^/:\[\]]+)(?::(?P<port>\d+))?):(?P<path>.*)$')
+DEFAULT_PORT = 7722
+# Messages are frames of a kind, a length and that many bytes of payload, sent through one zlib stream per direction.
+FRAME_HEADER = struct.Struct('!cI')
+# Files in the index stream: size, mtime and the lengths of the relpath and the digest, which follow. Files without a
+# digest have one of length 0.
+FD_HEADER = struct.Struct('!QdHB')
+FDS_PER_FRAME = 1000
+# Bytes of file data per frame.
+CHUNK_SIZE = 256 * 1024
+# Favour speed over ratio, so that a fast link does not wait for the compressor.
+COMPRESSION_LEVEL = 1
+# Operations sent ahead of their acknowledgements.
+WINDOW = 64
+# The shared secret clients present when opening a directory.
+TOKEN_VARIABLE = 'PYSYNC_TOKEN'
+
+# Frame kinds. Requests carry JSON, except for file data.
+OPEN, INDEX, COPY, DATA, END, MOVE, DELETE = 'O', 'I', 'C', 'D', 'Z', 'M', 'R'
+FILES, DONE, ACK, ERROR = 'F', 'E', 'A', 'X'
+
+def parse_location(location):
+    '''Return the address and path of a served directory, the address being a Unix socket path or a (host, port)
+    pair, or `None` for a local directory.'''
+    match = LOCATION_REGEX.match(location)
+    if not match: return None
+    if match.group('socket'): return match.group('socket'), match.group('path')
+    return (match.group('host'), int(match.group('port') or DEFAULT_PORT)), match.group('path')
+
+def get_token():
+    return os.environ.get(TOKEN_VARIABLE) or None
+
+def create_socket(address):
+    return socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM)
+
+def hexdigest(digest):
+    return binascii.hexlify(digest) if digest is not None else None
+
+def encode_fds(fds):
+    parts = []
+    for fd in fds:
+        relpath = fd.relpath.encode('utf-8') if isinstance(fd.relpath, unicode) else fd.relpath
+        digest = fd.digest or ''
+        parts += [FD_HEADER.pack(fd.size, fd.mtime, len(relpath), len(digest)), relpath, digest]
+    return ''.join(parts)
+
+def decode_fds(data):
+    fds = []
+    offset = 0
+    while offset < len(data):
+        size, mtime, relpath_length, digest_length = FD_HEADER.unpack_from(data, offset)
+        offset += FD_HEADER.size
+        relpath = data[offset:offset + relpath_length]
+        digest = data[offset + relpath_length:offset + relpath_length + digest_length] or None
+        offset += relpath_length + digest_length
+        fds.append(core.FileDescriptor(relpath, mtime, size, digest=digest))
+    return fds
+
+class Channel:
+    '''A connection that carries frames, compressed. Frames are buffered until `flush`, so that pipelined ones share
+    packets. One thread may send while another receives.'''
+    def __init__(self, sock):
+        self.sock = sock
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self.decompressor = zlib.decompressobj()
+        self.output = []
+        self.input = ''
+        self.offset = 0
+
+    def send(self, kind, payload=''):
+        self.output.append(self.compressor.compress(FRAME_HEADER.pack(kind, len(payload)) + payload))
+
+    def send_json(self, kind, message):
+        self.send(kind, json.dumps(message))
+
+    def flush(self):
+        data = ''.join(self.output) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.output = []
+        self.sock.sendall(data)
+        metrics.count('network_bytes_sent', len(data))
+
+    def ready(self):
+        '''Whether a whole frame has been received already, i.e., `receive` will not block.'''
+        if len(self.input) - self.offset < FRAME_HEADER.size: return False
+        return len(self.input) - self.offset - FRAME_HEADER.size >= FRAME_HEADER.unpack_from(self.input, self.offset)[1]
+
+    def receive(self):
+        '''Return the (kind, payload) of the next frame. Raises an `EOFError` if the connection is closed.'''
+        while not self.ready():
+            data = self.sock.recv(64 * 1024)
+            if not data: raise EOFError('Connection closed')
+            metrics.count('network_bytes_received', len(data))
+            self.input = self.input[self.offset:] + self.decompressor.decompress(data)
+            self.offset = 0
+        kind, length = FRAME_HEADER.unpack_from(self.input, self.offset)
+        start = self.offset + FRAME_HEADER.size
+        self.offset = start + length
+        return kind, self.input[start:self.offset]
+
+    def close(self):
+        self.sock.close()
+
+class AuthenticationError(ValueError):
+    pass
+
+class Server:
+    '''Serves the directory `basepath` to `Client`s that present `token`, one `Session` thread per connection.'''
+    def __init__(self, basepath, get_archive, jobs=1, processes=False, token=None):
+        self.basepath = os.path.realpath(basepath)
+        self.get_archive = get_archive
+        self.jobs = jobs
+        self.processes = processes
+        self.token = token
+
+    def serve(self, address):
+        # Any user who can connect may write to the served directory: over TCP, only those who know the token.
+        if not isinstance(address, str) and not self.token:
+            raise ValueError('Serving over TCP needs a token in ${}'.format(TOKEN_VARIABLE))
+        listener = create_socket(address)
+        try:
+            if isinstance(address, str):
+                if os.path.exists(address): os.remove(address)
+                # Only the owner may connect to the socket.
+                umask = os.umask(0o077)
+                try:
+                    listener.bind(address)
+                finally:
+                    os.umask(umask)
+            else:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind(address)
+            listener.listen(5)
+            print 'Serving {} on {}.'.format(self.basepath, address if isinstance(address, str) else '{}:{}'.format(*address))
+            sys.stdout.flush()
+            while True:
+                sock, peer = listener.accept()
+                thread = threading.Thread(target=Session(self, Channel(sock)).run)
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+            if isinstance(address, str) and os.path.exists(address): os.remove(address)
+
+    def resolve(self, path, base=None):
+        '''Return the absolute path of `path` relative to `base` (by default, the served directory), refusing paths
+        that lead outside the served directory, also through symlinks.'''
+        path = os.path.normpath(os.path.join(base or self.basepath, path.lstrip(os.sep)))
+        # Only the last component is left unresolved, so that a symlink itself can be replaced or removed.
+        head, tail = os.path.split(path)
+        resolved = os.path.realpath(path) if tail in ('', '..') else os.path.join(os.path.realpath(head), tail)
+        if resolved != self.basepath and not resolved.startswith(self.basepath + os.sep):
+            raise OSError(errno.EACCES, 'Outside of the served directory', path)
+        return resolved
+
+class Session:
+    '''The requests of one `Client` connection: `OPEN` a directory first, then `INDEX` it or send operations on it.'''
+    def __init__(self, server, channel):
+        self.server = server
+        self.channel = channel
+        self.directory = self.archive = None
+
+    def run(self):
+        handlers = {OPEN: self.open, INDEX: self.index, COPY: self.copy, MOVE: self.move, DELETE: self.delete}
+        try:
+            while True:
+                kind, payload = self.channel.receive()
+                request = json.loads(payload)
+                try:
+                    if kind not in handlers: raise ValueError('Unknown request {!r}'.format(kind))
+                    if kind != OPEN and self.archive is None: raise ValueError('No directory opened')
+                    handlers[kind](request)
+                except (EnvironmentError, ValueError) as e:
+                    self.channel.send_json(ERROR, {'id': request.get('id'), 'error': str(e),
+                                                   'mismatch': isinstance(e, transfer.VerificationError)})
+                    if isinstance(e, AuthenticationError):
+                        self.channel.flush()
+                        break
+                if not self.channel.ready(): self.channel.flush()
+        except EOFError:
+            pass
+        finally:
+            if self.archive: self.archive.close()
+            self.channel.close()
+
+    def open(self, request):
+        if self.server.token and not hmac.compare_digest(str(request.get('token') or ''), self.server.token):
+            raise AuthenticationError('Invalid token')
+        self.directory = self.server.resolve(request['path'])
+        if not os.path.isdir(self.directory): raise OSError(errno.ENOENT, 'No such directory', request['path'])
+        # SQLite connections are bound to their thread, so each session opens its own archive.
+        self.archive = self.server.get_archive(self.directory)
+        self.channel.send_json(ACK, {'algorithm': self.archive.get_algorithm()})
+
+    def index(self, request):
+        fileindex = core.create_index(self.directory, excludes=request['excludes'], archive=self.archive,
+                                      jobs=self.server.jobs, processes=self.server.processes, full=request['full'],
+                                      algorithm=request['algorithm'])
+        for start in xrange(0, len(fileindex.files), FDS_PER_FRAME):
+            self.channel.send(FILES, encode_fds(fileindex.files[start:start + FDS_PER_FRAME]))
+            self.channel.flush()
+        self.channel.send_json(DONE, {'files': len(fileindex.files)})
+
+    def copy(self, request):
+        '''Receive a file into a temporary file next to its target, and rename it over the target once complete.'''
+        path = self.server.resolve(request['relpath'], self.directory)
+        temp_path = path + '.pysync-part'
+        m = hash.new(request['algorithm']) if request['verify'] and request['digest'] else None
+        error = None
+        try:
+            if not request['overwrite'] and os.path.exists(path):
+                raise OSError(errno.EEXIST, 'Target file exists', path)
+            if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+            f = open(temp_path, 'wb')
+        except EnvironmentError as e:
+            error, f = e, None
+        # Take in all of the data even after a failure, to stay in step with the client.
+        while True:
+            kind, payload = self.channel.receive()
+            if kind == END: break
+            if kind != DATA: raise ValueError('Unexpected request {!r} during a copy'.format(kind))
+            if error: continue
+            try:
+                f.write(payload)
+                if m: m.update(payload)
+            except EnvironmentError as e:
+                error = e
+        end = json.loads(payload)
+        if f: f.close()
+        try:
+            if error: raise error
+            if end.get('error'): raise IOError(errno.EIO, 'Reading the source failed: {}'.format(end['error']))
+            if m and m.hexdigest() != request['digest']:
+                raise transfer.VerificationError(errno.EIO, 'Received data does not match the indexed {} digest {}'.format(
+                    request['algorithm'], request['digest']), path)
+            os.chmod(temp_path, request['mode'])
+            os.rename(temp_path, path)
+        except:
+            if os.path.lexists(temp_path): os.remove(temp_path)
+            raise
+        st = os.stat(path)
+        self.archive.insert(core.FileDescriptor(request['relpath'], st.st_mtime, st.st_size, sha256=request['digest']))
+        self.channel.send_json(ACK, {'id': request['id'], 'verified': m is not None})
+
+    def move(self, request):
+        old_path = self.server.resolve(request['old_relpath'], self.directory)
+        path = self.server.resolve(request['relpath'], self.directory)
+        core.move(old_path, path, overwrite=request['overwrite'])
+        old_fd = core.FileDescriptor(request['old_relpath'], 0, 0)
+        self.archive.rename_blocks(old_fd.relpath, request['relpath'])
+        self.archive.delete(old_fd)
+        st = os.stat(path)
+        self.archive.insert(core.FileDescriptor(request['relpath'], st.st_mtime, st.st_size, sha256=request['digest']))
+        self.channel.send_json(ACK, {'id': request['id']})
+
+    def delete(self, request):
+        os.remove(self.server.resolve(request['relpath'], self.directory))
+        self.archive.delete(core.FileDescriptor(request['relpath'], 0, 0))
+        self.channel.send_json(ACK, {'id': request['id']})
+
+class Client:
+    '''Connection to a `Server` for the served directory at `location`. It stands in for the `Archive` of that
+    directory in a sync, as the server keeps the archive itself; a `RemoteExecutor` sends it the operations.'''
+    def __init__(self, location):
+        address, path = parse_location(location)
+        self.path = location
+        sock = create_socket(address)
+        sock.connect(address)
+        if not isinstance(address, str): sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.channel = Channel(sock)
+        self.channel.send_json(OPEN, {'path': path, 'token': get_token()})
+        self.channel.flush()
+        self.algorithm = self.reply()['algorithm']
+
+    def reply(self):
+        kind, payload = self.channel.receive()
+        message = json.loads(payload)
+        if kind == ERROR: raise IOError('{}: {}'.format(self.path, message['error']))
+        return message
+
+    def index(self, excludes=[], full=True, algorithm=hash.DEFAULT_ALGORITHM, label=None):
+        '''Have the server index its directory and return the `FileIndex` it sends. The directories are walked and
+        hashed on the server, next to the data.'''
+        starttime = time.time()
+        self.channel.send_json(INDEX, {'excludes': excludes, 'full': full, 'algorithm': algorithm})
+        self.channel.flush()
+        fileindex = core.FileIndex(self.path, algorithm)
+        progress = metrics.Progress('[{}] Received'.format(label) if label else 'Received')
+        while True:
+            kind, payload = self.channel.receive()
+            if kind != FILES: break
+            fds = decode_fds(payload)
+            fileindex.files += fds
+            for fd in fds: progress.add(fd.size)
+        progress.finish()
+        if kind == ERROR: raise IOError('{}: {}'.format(self.path, json.loads(payload)['error']))
+        self.algorithm = algorithm
+        metrics.count('files_received', len(fileindex.files))
+        metrics.add_time('index', time.time() - starttime)
+        return fileindex
+
+    def get_algorithm(self):
+        return self.algorithm
+
+    def get_blocks(self, fd):
+        # Delta copies need the old contents locally.
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.channel.close()
+
+class RemoteExecutor(executor.Executor):
+    '''Runs the `executor.Operation`s on the directory of a `Client`, sending up to `WINDOW` of them ahead of their
+    acknowledgements. Operations on the local side are left to the `executor.Executor`.'''
+    def __init__(self, client, **kwargs):
+        executor.Executor.__init__(self, **kwargs)
+        self.client = client
+
+    def run(self, operations):
+        local_operations = [op for op in operations if op.archive is not self.client]
+        for operation in local_operations:
+            if operation.kind == executor.Operation.COPY:
+                sys.stderr.write('Could not copy {} to {}: copying from a served directory is not supported\n'.format(
+                    operation.source_path, operation.target_path))
+        sys.stderr.flush()
+        executor.Executor.run(self, [op for op in local_operations if op.kind != executor.Operation.COPY])
+
+        operations = [op for op in operations if op.archive is self.client]
+        if self.journal: operations = [op for op in operations if op.key() not in self.journal]
+        operations.sort(key=lambda op: op.kind != executor.Operation.MOVE)
+        for operation in operations: print operation.describe()
+        if self.dryrun or not operations: return
+        starttime = time.time()
+        self.num_files = self.num_bytes = self.verified_files = 0
+        self.mismatches = []
+        replies = Queue.Queue()
+        window = threading.Semaphore(WINDOW)
+        receiver = threading.Thread(target=self.receive, args=(len(operations), replies, window))
+        receiver.daemon = True
+        receiver.start()
+        outstanding = 0
+        for index, operation in enumerate(operations):
+            window.acquire()
+            try:
+                self.send(index, operation)
+                outstanding += 1
+            except EnvironmentError as e:
+                window.release()
+                self.finish_remote(operation, e)
+            while not replies.empty():
+                self.finish_reply(operations, replies.get())
+                outstanding -= 1
+        while outstanding > 0:
+            self.finish_reply(operations, replies.get())
+            outstanding -= 1
+
+        elapsedtime = time.time() - starttime
+        metrics.add_time('copy', elapsedtime)
+        print 'Transferred {} files ({:.1f} MB) in {}: {:.1f} files/s, {:.1f} MB/s.'.format(
+            self.num_files, self.num_bytes / 1e6, datetime.timedelta(seconds=elapsedtime),
+            self.num_files / max(elapsedtime, 1e-6), self.num_bytes / 1e6 / max(elapsedtime, 1e-6))
+        if self.verify: self.report_verification()
+
+    def send(self, index, operation):
+        channel = self.client.channel
+        if operation.kind == executor.Operation.DELETE:
+            channel.send_json(DELETE, {'id': index, 'relpath': operation.old_fd.relpath})
+        elif operation.kind == executor.Operation.MOVE:
+            channel.send_json(MOVE, {'id': index, 'relpath': operation.relpath, 'old_relpath': operation.old_fd.relpath,
+                                     'overwrite': operation.overwrite, 'digest': hexdigest(operation.digest)})
+        else:
+            # Open the source before announcing the copy, so that a missing one fails on its own.
+            with open(operation.source_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                operation.check_source(st)
+                channel.send_json(COPY, {'id': index, 'relpath': operation.relpath, 'overwrite': operation.overwrite,
+                                         'digest': hexdigest(operation.digest),
+                                         'mode': st.st_mode & 0o7777, 'verify': self.verify,
+                                         'algorithm': self.algorithm})
+                error = None
+                try:
+                    while True:
+                        data = f.read(CHUNK_SIZE)
+                        if not data: break
+                        channel.send(DATA, data)
+                        operation.transferred += len(data)
+                        channel.flush()
+                except EnvironmentError as e:
+                    error = str(e)
+                channel.send_json(END, {'error': error})
+        channel.flush()
+
+    def receive(self, num_replies, replies, window):
+        received = 0
+        try:
+            while received < num_replies:
+                kind, payload = self.client.channel.receive()
+                replies.put((kind, json.loads(payload)))
+                received += 1
+                window.release()
+        except (EOFError, EnvironmentError) as e:
+            # Fail whatever is left, so that `run` does not wait forever.
+            for i in xrange(received, num_replies):
+                replies.put((ERROR, {'id': None, 'error': str(e)}))
+                window.release()
+
+    def finish_reply(self, operations, reply):
+        kind, reply = reply
+        if reply['id'] is None:
+            sys.stderr.write('Lost the connection to {}: {}\n'.format(self.client.path, reply['error']))
+            sys.stderr.flush()
+            return
+        operation = operations[reply['id']]
+        if kind == ERROR:
+            if reply.get('mismatch'): self.mismatches.append(operation)
+            self.finish_remote(operation, reply['error'])
+        else:
+            operation.verified = reply.get('verified', False)
+            self.finish_remote(operation, None)
+
+    def finish_remote(self, operation, error):
+        if error:
+            if operation.kind == executor.Operation.DELETE:
+                sys.stderr.write('Could not delete {}: {}\n'.format(operation.target_path, error))
+            else:
+                sys.stderr.write('Could not {} {} to {}: {}\n'.format(operation.kind, operation.source_path, operation.target_path, error))
+            sys.stderr.flush()
+            return
+        if self.journal: self.journal.record(operation.key())
+        if operation.kind == executor.Operation.COPY:
+            self.num_files += 1
+            self.num_bytes += operation.transferred
+            if operation.verified: self.verified_files += 1
+            metrics.count('files_copied')
+            metrics.count('bytes_copied', operation.transferred)
@@ -0,0 +1,174 @@
+import ctypes, ctypes.util, errno, fcntl, hash, os
+
+# ioctl to share the extents of a file (reflink), and the lseek whences to find the data in sparse files.
+FICLONE = 0x40049409
+SEEK_DATA, SEEK_HOLE = 3, 4
+# Bytes per system call for in-kernel copies, and per read/write for userspace copies.
+CHUNK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+# Mechanisms from fastest to most widely supported.
+MECHANISMS = ['reflink', 'copy_file_range', 'sendfile', 'userspace']
+# Errors that mean a mechanism is not available for the given files.
+UNSUPPORTED_ERRNOS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF])
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    libc = None
+c_copy_file_range = getattr(libc, 'copy_file_range', None)
+if c_copy_file_range:
+    c_copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                                  ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+    c_copy_file_range.restype = ctypes.c_ssize_t
+c_sendfile = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+if c_sendfile:
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+class Unsupported(Exception):
+    '''Raised by a copy mechanism that cannot be used; `offset` tells how far it got.'''
+    def __init__(self, offset):
+        Exception.__init__(self, offset)
+        self.offset = offset
+
+def copyfile(source_path, target_path, mechanisms=MECHANISMS):
+    '''Copy the contents of `source_path` to `target_path` with the first of the `mechanisms` that works, keeping
+    holes of sparse files. Returns the mechanism that did (most of) the copying.'''
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        source_fd, target_fd = source.fileno(), target.fileno()
+        source_stat, target_stat = os.fstat(source_fd), os.fstat(target_fd)
+        if source_stat.st_dev != target_stat.st_dev:
+            mechanisms = [m for m in mechanisms if m not in ('reflink', 'copy_file_range')]
+        if 'reflink' in mechanisms:
+            try:
+                fcntl.ioctl(target_fd, FICLONE, source_fd)
+                return 'reflink'
+            except IOError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS: raise
+        mechanisms = [m for m in mechanisms if m != 'reflink']
+        for offset, end in data_segments(source_fd, source_stat.st_size):
+            while offset < end:
+                try:
+                    offset = COPY_FUNCTIONS[mechanisms[0]](source_fd, target_fd, offset, end)
+                    break
+                except Unsupported as e:
+                    if len(mechanisms) == 1: raise OSError(errno.ENOSYS, 'No copy mechanism available')
+                    offset = e.offset
+                    mechanisms = mechanisms[1:]
+        # Extend the file over a trailing hole.
+        target.truncate(source_stat.st_size)
+        return mechanisms[0]
+
+def reflink(source_path, target_path):
+    '''Create `target_path` as a reflink of `source_path`, sharing its extents. Raises an `IOError` if the file system
+    does not support it.'''
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+class VerificationError(IOError):
+    '''Raised when the data copied does not have the expected digest.'''
+
+def copyfile_verified(source_path, target_path, digest, algorithm=hash.DEFAULT_ALGORITHM):
+    '''Copy like `copyfile`, but through userspace, hashing the data on its way and raising a `VerificationError` if it
+    does not match the (binary) `digest`. This reads each byte once for both copying and verifying.'''
+    m = hash.new(algorithm)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        source_fd, target_fd = source.fileno(), target.fileno()
+        size = os.fstat(source_fd).st_size
+        offset = 0
+        for start, end in data_segments(source_fd, size):
+            hash_zeros(m, start - offset)
+            offset = userspace(source_fd, target_fd, start, end, m)
+        hash_zeros(m, size - offset)
+        target.truncate(size)
+    if m.digest() != digest:
+        raise VerificationError(errno.EIO, 'Copied data does not match the indexed {} digest {}'.format(algorithm, digest.encode('hex')), source_path)
+
+def delta_copy(source_path, target_path, source_blocks, target_blocks, block_size, algorithm=None):
+    '''Update `target_path` in place to `source_path`, writing only the blocks whose digests differ and, given an
+    `algorithm`, checking them. Returns the number of bytes written.'''
+    transferred = 0
+    with open(source_path, 'rb') as source, open(target_path, 'r+b') as target:
+        source_fd, target_fd = source.fileno(), target.fileno()
+        size = os.fstat(source_fd).st_size
+        for index, digest in enumerate(source_blocks):
+            if index < len(target_blocks) and target_blocks[index] == digest: continue
+            offset = index * block_size
+            end = min(offset + block_size, size)
+            m = hash.new(algorithm) if algorithm else None
+            transferred += userspace(source_fd, target_fd, offset, end, m) - offset
+            if m and m.digest() != digest:
+                raise VerificationError(errno.EIO, 'Copied block at offset {} does not match the indexed {} digest {}'.format(
+                    offset, algorithm, digest.encode('hex')), source_path)
+        target.truncate(size)
+    return transferred
+
+def hash_zeros(m, length):
+    '''Feed `length` zero bytes, i.e., a hole, into the hash `m`.'''
+    zeros = '\0' * min(length, BUFFER_SIZE)
+    while length > 0:
+        m.update(zeros[:length])
+        length -= len(zeros)
+
+def data_segments(fd, size):
+    '''Yield the (start, end) offsets of the regions of the file that hold data, i.e., are not holes.'''
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO: return
+            elif e.errno in UNSUPPORTED_ERRNOS:
+                yield offset, size
+                return
+            raise
+        yield start, min(end, size)
+        offset = end
+
+def raise_errno(offset):
+    err = ctypes.get_errno()
+    if err in UNSUPPORTED_ERRNOS: raise Unsupported(offset)
+    raise OSError(err, os.strerror(err))
+
+def copy_file_range(source_fd, target_fd, offset, end):
+    if not c_copy_file_range: raise Unsupported(offset)
+    source_offset, target_offset = ctypes.c_int64(offset), ctypes.c_int64(offset)
+    while source_offset.value < end:
+        n = c_copy_file_range(source_fd, ctypes.byref(source_offset), target_fd, ctypes.byref(target_offset),
+                              min(CHUNK_SIZE, end - source_offset.value), 0)
+        if n < 0:
+            if ctypes.get_errno() == errno.EINTR: continue
+            raise_errno(source_offset.value)
+        elif n == 0: break
+    return source_offset.value
+
+def sendfile(source_fd, target_fd, offset, end):
+    if not c_sendfile: raise Unsupported(offset)
+    source_offset = ctypes.c_int64(offset)
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    while source_offset.value < end:
+        n = c_sendfile(target_fd, source_fd, ctypes.byref(source_offset), min(CHUNK_SIZE, end - source_offset.value))
+        if n < 0:
+            if ctypes.get_errno() == errno.EINTR: continue
+            raise_errno(source_offset.value)
+        elif n == 0: break
+    return source_offset.value
+
+def userspace(source_fd, target_fd, offset, end, m=None):
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    while offset < end:
+        data = os.read(source_fd, min(BUFFER_SIZE, end - offset))
+        if not data: break
+        if m: m.update(data)
+        write_fully(target_fd, data)
+        offset += len(data)
+    return offset
+
+def write_fully(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+COPY_FUNCTIONS = {'copy_file_range': copy_file_range, 'sendfile': sendfile, 'userspace': userspace}
@@ -0,0 +1,207 @@
+import ctypes, ctypes.util, errno, os, select, stat, struct, sys, time, core, hash, metrics
+
+# inotify event masks, from <sys/inotify.h>.
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event: wd, mask, cookie and the length of the name that follows.
+EVENT_HEADER = struct.Struct('iIII')
+# Seconds between check-ins in the archive, which tell that the watcher is alive.
+HEARTBEAT_INTERVAL = 5.0
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    libc = None
+
+def check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def is_below(path, directory):
+    '''Whether `path` is `directory` or inside it.'''
+    return path == directory or path.startswith(directory + os.sep)
+
+class Watcher:
+    '''Keeps the `archive` of `basepath` current with inotify, hashing changed files once left alone for `debounce`
+    seconds. While it runs, `core.create_index` trusts the archive instead of walking.'''
+    def __init__(self, basepath, archive, includes=[], excludes=[], jobs=1, processes=False,
+                 algorithm=hash.DEFAULT_ALGORITHM, debounce=2.0):
+        if not libc or not hasattr(libc, 'inotify_init1'): raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.basepath = os.path.normpath(basepath)
+        self.archive = archive
+        self.includes = includes
+        self.excludes = excludes
+        self.jobs = jobs
+        self.processes = processes
+        self.algorithm = algorithm
+        self.debounce = debounce
+        self.filefilter = core.FileFilter(includes=includes, excludes=excludes, basepath=basepath)
+        self.fd = None
+        # Watched directories by watch descriptor.
+        self.watches = dict()
+        # Paths to hash by the time of their last event, and (fd, result) of those being hashed.
+        self.dirty = dict()
+        self.hashing = dict()
+        self.last_heartbeat = 0
+        self.settled = False
+
+    def run(self):
+        self.fd = check(libc.inotify_init1(IN_CLOEXEC))
+        self.hashpool = hash.HashPool(jobs=self.jobs, processes=self.processes, algorithm=self.algorithm)
+        self.progress = metrics.Progress('Hashed')
+        try:
+            self.rescan()
+            print 'Watching {}.'.format(self.basepath)
+            while True:
+                if select.select([self.fd], [], [], 0.5)[0]: self.read_events()
+                self.hash_dirty()
+                self.collect_hashes()
+                # Tell right away when the archive falls behind or catches up.
+                settled = not self.dirty and not self.hashing
+                if settled != self.settled or time.time() - self.last_heartbeat >= HEARTBEAT_INTERVAL: self.heartbeat()
+                elif self.archive.writes: self.archive.flush()
+        finally:
+            self.progress.finish()
+            self.archive.set_meta('watch_pid', None)
+            self.archive.flush()
+            self.hashpool.close()
+            os.close(self.fd)
+
+    def rescan(self):
+        '''Watch all directories and index them fully, to start with and after events were lost.'''
+        for wd in self.watches.keys():
+            libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+        self.dirty.clear()
+        # Watch first, so that changes made during the walk are not missed.
+        self.add_watches(self.basepath)
+        core.create_index(self.basepath, includes=self.includes, excludes=self.excludes, archive=self.archive,
+                          jobs=self.jobs, processes=self.processes, collect=False, algorithm=self.algorithm)
+        self.heartbeat()
+
+    def add_watches(self, path):
+        '''Watch the directory `path` and all below it. Returns the files found.'''
+        files = []
+        for directory, subdirs, names in os.walk(path):
+            subdirs[:] = [d for d in subdirs if not self.filefilter.is_filtered(os.path.join(directory, d), is_dir=True)]
+            try:
+                wd = check(libc.inotify_add_watch(self.fd, directory, WATCH_MASK))
+            except OSError as e:
+                sys.stderr.write('Could not watch {}: {}\n'.format(directory, e))
+                sys.stderr.flush()
+                continue
+            self.watches[wd] = directory
+            files += [os.path.join(directory, name) for name in names]
+        return files
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR: return
+            raise
+        # Files moved away by cookie, to be matched with where they were moved to.
+        moved_from = dict()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                sys.stderr.write('Events were lost, indexing {} again.\n'.format(self.basepath))
+                sys.stderr.flush()
+                self.rescan()
+                return
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name: continue
+            path = os.path.join(self.watches[wd], name)
+            if name == core.IGNORE_FILE:
+                # The rules changed, so what to watch and index may have, too.
+                sys.stderr.write('{} changed, indexing {} again.\n'.format(path, self.basepath))
+                sys.stderr.flush()
+                self.filefilter = core.FileFilter(includes=self.includes, excludes=self.excludes, basepath=self.basepath)
+                self.rescan()
+                return
+            if self.filefilter.is_filtered(path, is_dir=mask & IN_ISDIR): continue
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = path
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                self.moved(moved_from.pop(cookie), path, mask & IN_ISDIR)
+            elif mask & (IN_MOVED_TO | IN_CREATE) and mask & IN_ISDIR:
+                for file in self.add_watches(path): self.dirty[file] = time.time()
+            elif mask & IN_DELETE:
+                self.deleted(path)
+            elif not mask & IN_ISDIR:
+                self.dirty[path] = time.time()
+        # Whatever was moved out of the directory is gone.
+        for path in moved_from.itervalues(): self.deleted(path)
+
+    def moved(self, path, new_path, is_dir):
+        self.archive.rename_tree(self.relpath(path), self.relpath(new_path))
+        for old_path in self.dirty.keys():
+            if is_below(old_path, path): self.dirty[new_path + old_path[len(path):]] = self.dirty.pop(old_path)
+        # Hashes under way would be stored under the old paths, so hash those files again under the new ones.
+        for old_path in self.hashing.keys():
+            if is_below(old_path, path):
+                del self.hashing[old_path]
+                self.dirty[new_path + old_path[len(path):]] = time.time()
+        if is_dir:
+            for wd, directory in self.watches.items():
+                if is_below(directory, path): self.watches[wd] = new_path + directory[len(path):]
+
+    def deleted(self, path):
+        self.archive.delete_tree(self.relpath(path))
+        for pending in (self.dirty, self.hashing):
+            for old_path in pending.keys():
+                if is_below(old_path, path): del pending[old_path]
+        for wd, directory in self.watches.items():
+            if is_below(directory, path):
+                libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def hash_dirty(self):
+        '''Hash the files that have been left alone for long enough, unless the archive has them already.'''
+        now = time.time()
+        for path, last_event in self.dirty.items():
+            if now - last_event < self.debounce or path in self.hashing: continue
+            del self.dirty[path]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode): continue
+            fd = core.FileDescriptor(self.relpath(path), st.st_mtime, st.st_size)
+            old_fd = self.archive.get(fd.relpath)
+            if old_fd and old_fd.digest is not None and old_fd.size == fd.size and old_fd.mtime == fd.mtime: continue
+            self.hashing[path] = (fd, self.hashpool.submit(path))
+
+    def collect_hashes(self):
+        for path, (fd, result) in self.hashing.items():
+            if not result.ready(): continue
+            del self.hashing[path]
+            try:
+                fd.digest = result.get()[0]
+            except EnvironmentError as e:
+                sys.stderr.write('Could not process {}: {}\n'.format(path, e))
+                sys.stderr.flush()
+                continue
+            self.progress.add(fd.size)
+            self.archive.insert(fd)
+
+    def heartbeat(self):
+        self.archive.set_meta('watch_pid', str(os.getpid()))
+        self.archive.set_meta('watch_heartbeat', repr(time.time()))
+        self.archive.set_meta('watch_pending', str(len(self.dirty) + len(self.hashing)))
+        self.archive.flush()
+        self.settled = not self.dirty and not self.hashing
+        self.last_heartbeat = time.time()
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.basepath)